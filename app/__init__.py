@@ -1,20 +1,47 @@
-import logging, os
+import os
+import click
 from flask import Flask, request, current_app
+from jinja2 import FileSystemBytecodeCache
 from flask_babel import Babel
 from flask_sqlalchemy import SQLAlchemy
 from flask_mail import Mail
-from flask_migrate import Migrate
 from flask_moment import Moment
 from config import Config
+from app.activity import LastSeenTracker
+from app.mailqueue import MailQueue
+from app.logs import init_logging
+from app.fragments import FragmentCache
+from app.search import Search
+from app.perf import PerfStats
+from app.hashing import PasswordHasher
+from app.usercache import UserCache
+from app.graph import FollowGraph
+from app.stream import StreamHub
+from app.admission import AdmissionControl
+from app.tags import TagIndex
+from app.avatars import AvatarCache
+from app.compression import Compression
+from app.database import RoutingSession, configure_pool, init_replicas, tune_sqlite
 from flask_login import LoginManager
-from logging.handlers import SMTPHandler, RotatingFileHandler
 
-db = SQLAlchemy()
-migrate = Migrate()
+db = SQLAlchemy(session_options={'class_': RoutingSession})
 login = LoginManager()
 mail = Mail()
+mail_queue = MailQueue()
 moment = Moment()
 babel = Babel()
+last_seen = LastSeenTracker()
+fragments = FragmentCache()
+search = Search()
+perf = PerfStats()
+hasher = PasswordHasher()
+user_cache = UserCache()
+graph = FollowGraph()
+stream_hub = StreamHub()
+admission = AdmissionControl()
+tags = TagIndex()
+avatars = AvatarCache()
+compression = Compression()
 login.login_view = 'routes.login'
 
 def get_locale():
@@ -23,13 +50,47 @@ def get_locale():
 def create_app(config_inst=Config):
     app = Flask(__name__)
     app.config.from_object(config_inst)
+    if app.config['TEMPLATE_CACHE_DIR']:    # before anything touches app.jinja_env
+        os.makedirs(app.config['TEMPLATE_CACHE_DIR'], exist_ok=True)
+        app.jinja_options = {**app.jinja_options,
+                             'bytecode_cache': FileSystemBytecodeCache(app.config['TEMPLATE_CACHE_DIR'])}
 
+    configure_pool(app)
     db.init_app(app)
-    migrate.init_app(app, db)
+    init_replicas(app)
+    tune_sqlite(app)
+    # only `flask db` needs Flask-Migrate and alembic, web workers never import them
+    if click.get_current_context(silent=True) is not None:
+        from flask_migrate import Migrate
+        Migrate(app, db)
     login.init_app(app)
     mail.init_app(app)
+    mail_queue.init_app(app)
     moment.init_app(app)
     babel.init_app(app, locale_selector=get_locale)
+    last_seen.init_app(app)
+    fragments.init_app(app)
+    search.init_app(app)
+    perf.init_app(app)
+    hasher.init_app(app)
+    user_cache.init_app(app)
+    graph.init_app(app)
+    stream_hub.init_app(app)
+    tags.init_app(app)
+    avatars.init_app(app)
+    compression.init_app(app)
+    admission.init_app(app)     # after perf, so time spent queued shows up in Server-Timing
+    perf.register('last_seen', last_seen.stats)
+    perf.register('fragments', fragments.stats)
+    perf.register('mail_queue', mail_queue.stats)
+    perf.register('hasher', hasher.stats)
+    perf.register('user_cache', user_cache.stats)
+    perf.register('graph', graph.stats)
+    perf.register('stream', stream_hub.stats)
+    perf.register('admission', admission.stats)
+    perf.register('tags', tags.stats)
+    perf.register('avatars', avatars.stats)
+    perf.register('compression', compression.stats)
 
     from app.errors.error import bp as errors_bp
     app.register_blueprint(errors_bp)
@@ -37,34 +98,24 @@ def create_app(config_inst=Config):
     from app.routes.route import bp as routes_bp
     app.register_blueprint(routes_bp)
 
-    if not app.debug:
-        if app.config['MAIL_SERVER']:
-            auth = None
-            if app.config['MAIL_USERNAME'] or app.config['MAIL_PASSWORD']:
-                auth = (app.config['MAIL_USERNAME'], app.config['MAIL_PASSWORD'])
-            secure = None
-            if app.config['MAIL_USE_TLS']:
-                secure = ()
-            mail_handler = SMTPHandler(
-                mailhost=(app.config['MAIL_SERVER'], app.config['MAIL_PORT']),
-                fromaddr='no-reply@' + app.config['MAIL_SERVER'],
-                toaddrs=app.config['ADMINS'],
-                subject='FAIL IN BLOGAPP',
-                credentials=auth,
-                secure=secure
-            )
-            mail_handler.setLevel(logging.ERROR)
-            app.logger.addHandler(mail_handler)
+    from app.api.api import bp as api_bp
+    app.register_blueprint(api_bp)
 
-            if not os.path.exists('logs'):
-                os.mkdir('logs')
-            file_handler = RotatingFileHandler('logs/blogapp.log', maxBytes=10240, backupCount=10)
-            file_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]'))
-            file_handler.setLevel(logging.INFO)
-            app.logger.addHandler(file_handler)
+    from app.cli import bp as cli_bp
+    app.register_blueprint(cli_bp)
 
-            app.logger.setLevel(logging.INFO)
-            app.logger.info('Microblog startup')
+    from app.bench import bp as bench_bp
+    app.register_blueprint(bench_bp)
+
+    from app.data import bp as data_bp
+    app.register_blueprint(data_bp)
+
+    from app.avatars import bp as avatars_bp
+    app.register_blueprint(avatars_bp)
+
+    if not app.debug and not app.testing:
+        init_logging(app)
+        app.logger.info('Microblog startup')
 
     return app
 
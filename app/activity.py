@@ -0,0 +1,111 @@
+import atexit
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+import sqlalchemy as sa
+
+
+class LastSeenTracker:
+    """Write-behind tracker for User.last_seen.
+
+    Requests only record activity in memory. A user is scheduled for a write
+    when the stored value is older than LAST_SEEN_GRANULARITY seconds, and a
+    background thread persists all scheduled users every
+    LAST_SEEN_FLUSH_INTERVAL seconds with one batched UPDATE.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self._lock = threading.Lock()
+        self._pending = {}      # user id -> last_seen waiting to be written
+        self._scheduled = {}    # user id -> last value written or scheduled
+        self._thread = None
+        self._stop = threading.Event()
+        self._started = time.monotonic()
+        self.touches = 0
+        self.writes = 0
+        self.flushes = 0
+        atexit.register(self.shutdown)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['last_seen'] = self
+        with self._lock:    # state belongs to the previously bound app, if any
+            self._pending.clear()
+            self._scheduled.clear()
+        self.app = app
+
+    def touch(self, user):
+        now = datetime.now(timezone.utc)
+        granularity = timedelta(seconds=self.app.config['LAST_SEEN_GRANULARITY'])
+        user_id, last_seen = user.id, user.last_seen
+        with self._lock:
+            self.touches += 1
+            stored = self._scheduled.get(user_id) or last_seen
+            if stored is not None:
+                if stored.tzinfo is None:   # sqlite hands back naive UTC datetimes
+                    stored = stored.replace(tzinfo=timezone.utc)
+                if now - stored < granularity:
+                    return
+            self._pending[user_id] = now
+            self._scheduled[user_id] = now
+            self._ensure_flusher()
+
+    def flush(self):
+        from app import db
+        from app.models import User
+
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+        try:
+            with self.app.app_context():
+                db.session.execute(sa.update(User), [
+                    {'id': id, 'last_seen': last_seen} for id, last_seen in pending.items()])
+                db.session.commit()
+        except Exception:
+            with self._lock:    # keep the updates for the next round, newer values win
+                self._pending = {**pending, **self._pending}
+            raise
+        with self._lock:
+            self.writes += len(pending)
+            self.flushes += 1
+            cutoff = datetime.now(timezone.utc) - timedelta(seconds=self.app.config['LAST_SEEN_GRANULARITY'])
+            self._scheduled = {id: ts for id, ts in self._scheduled.items() if ts > cutoff}
+        return len(pending)
+
+    def shutdown(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self.app is not None:
+            self.flush()
+
+    def stats(self):
+        with self._lock:
+            uptime = time.monotonic() - self._started
+            return {
+                'touches': self.touches,
+                'writes': self.writes,
+                'flushes': self.flushes,
+                'pending': len(self._pending),
+                'writes_per_second': self.writes / uptime if uptime else 0.0,
+            }
+
+    def _ensure_flusher(self):
+        interval = self.app.config['LAST_SEEN_FLUSH_INTERVAL']
+        if interval and (self._thread is None or not self._thread.is_alive()):
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, args=(interval,),
+                                            name='last-seen-flusher', daemon=True)
+            self._thread.start()
+
+    def _run(self, interval):
+        while not self._stop.wait(interval):
+            try:
+                self.flush()
+            except Exception:
+                self.app.logger.exception('Failed to flush last_seen updates')
@@ -0,0 +1,171 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+from flask import g, request
+from flask_login import current_user
+from werkzeug.exceptions import ServiceUnavailable, TooManyRequests
+
+# (method, endpoint) -> endpoint class limited by ADMISSION_LIMITS
+ENDPOINT_CLASSES = {
+    ('GET', 'routes.index'): 'feeds',
+    ('GET', 'routes.explore'): 'feeds',
+    ('GET', 'routes.user'): 'feeds',
+    ('GET', 'routes.search_view'): 'feeds',
+    ('GET', 'routes.tag'): 'feeds',
+    ('GET', 'api.timeline'): 'feeds',
+    ('GET', 'api.explore'): 'feeds',
+    ('GET', 'api.user_posts'): 'feeds',
+    ('POST', 'routes.login'): 'auth',
+    ('POST', 'routes.register'): 'auth',
+    ('POST', 'routes.reset_password'): 'auth',
+    ('POST', 'routes.index'): 'writes',
+    ('POST', 'routes.follow'): 'writes',
+    ('POST', 'routes.unfollow'): 'writes',
+    ('POST', 'routes.edit_profile'): 'writes',
+    ('GET', 'avatars.avatar'): 'avatars',
+}
+
+# (method, endpoint) -> per-user token bucket in RATE_LIMITS
+RATE_LIMITED = {
+    ('POST', 'routes.index'): 'post',
+    ('POST', 'routes.follow'): 'follow',
+    ('POST', 'routes.unfollow'): 'follow',
+}
+
+
+class Limiter:
+    """At most `limit` requests at once, with up to `queue_size` more waiting for a slot."""
+
+    def __init__(self, limit, queue_size):
+        self.limit = limit
+        self.queue_size = queue_size
+        self._cond = threading.Condition()
+        self.active = 0
+        self.waiting = 0
+        self.max_waiting = 0
+        self.admitted = 0
+        self.shed = 0
+
+    def acquire(self, timeout):
+        with self._cond:
+            if self.active >= self.limit:
+                if self.waiting >= self.queue_size:
+                    self.shed += 1
+                    return False
+                self.waiting += 1
+                self.max_waiting = max(self.max_waiting, self.waiting)
+                try:
+                    admitted = self._cond.wait_for(lambda: self.active < self.limit, timeout)
+                finally:
+                    self.waiting -= 1
+                if not admitted:
+                    self.shed += 1
+                    return False
+            self.active += 1
+            self.admitted += 1
+            return True
+
+    def release(self):
+        with self._cond:
+            self.active -= 1
+            self._cond.notify()
+
+    def stats(self):
+        return {
+            'limit': self.limit,
+            'active': self.active,
+            'waiting': self.waiting,
+            'max_waiting': self.max_waiting,
+            'admitted': self.admitted,
+            'shed': self.shed,
+        }
+
+
+class TokenBuckets:
+    """One token bucket per key, refilled at `rate` tokens a second up to `burst`."""
+
+    def __init__(self, rate, burst, max_keys):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._lock = threading.Lock()
+        self._buckets = OrderedDict()   # key -> (tokens, monotonic time of last update)
+        self.limited = 0
+
+    def take(self, key):
+        """Spend a token for `key`, return 0 or the seconds until one is available."""
+        now = time.monotonic()
+        with self._lock:
+            tokens, stamp = self._buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - stamp) * self.rate)
+            if tokens >= 1:
+                self._buckets[key] = (tokens - 1, now)
+                self._buckets.move_to_end(key)
+                # an evicted key just starts over with a full bucket
+                while len(self._buckets) > self.max_keys:
+                    self._buckets.popitem(last=False)
+                return 0
+            self._buckets[key] = (tokens, now)
+            self.limited += 1
+        return (1 - tokens) / self.rate if self.rate else math.inf
+
+
+class AdmissionControl:
+    """Load shedding for the expensive endpoint classes.
+
+    Each class in ADMISSION_LIMITS (feeds, auth, writes, avatars) runs at most that
+    many requests at once per process. Up to ADMISSION_QUEUE_SIZE more wait
+    ADMISSION_QUEUE_TIMEOUT seconds for a slot, everything beyond that gets
+    an immediate 503 with Retry-After. Posting and following are also rate
+    limited per user by the token buckets in RATE_LIMITS, with a 429.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.limiters = {}
+        self.buckets = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['admission'] = self
+        self.app = app
+        self.limiters = {name: Limiter(limit, app.config['ADMISSION_QUEUE_SIZE'])
+                         for name, limit in app.config['ADMISSION_LIMITS'].items()}
+        self.buckets = {name: TokenBuckets(rate, burst, app.config['RATE_LIMIT_MAX_USERS'])
+                        for name, (rate, burst) in app.config['RATE_LIMITS'].items()}
+        app.before_request(self._admit)
+        app.teardown_request(self._release)
+
+    def stats(self):
+        return {
+            'classes': {name: limiter.stats() for name, limiter in self.limiters.items()},
+            'rate_limited': {name: buckets.limited for name, buckets in self.buckets.items()},
+        }
+
+    def _admit(self):
+        from app import perf
+
+        key = (request.method, request.endpoint)
+        buckets = self.buckets.get(RATE_LIMITED.get(key))
+        if buckets is not None and current_user.is_authenticated:
+            wait = buckets.take(current_user.id)
+            if wait:
+                return TooManyRequests(retry_after=math.ceil(min(wait, 3600))).get_response()
+        limiter = self.limiters.get(ENDPOINT_CLASSES.get(key))
+        if limiter is None:
+            return None
+        start = time.perf_counter()
+        if not limiter.acquire(self.app.config['ADMISSION_QUEUE_TIMEOUT']):
+            return ServiceUnavailable(retry_after=self.app.config['ADMISSION_RETRY_AFTER']).get_response()
+        g.admission = limiter
+        waited = (time.perf_counter() - start) * 1000
+        if waited >= 1:
+            perf.record('queue', waited)
+        return None
+
+    def _release(self, exc):
+        limiter = g.pop('admission', None)
+        if limiter is not None:
+            limiter.release()
@@ -0,0 +1,144 @@
+from datetime import timezone
+from flask import Blueprint, jsonify, request, current_app, abort
+from flask_login import current_user
+import sqlalchemy as sa
+from app import db, last_seen
+from app.models import User, Post, followers, get_user_by_username
+from app.pagination import keyset_paginate
+
+bp = Blueprint('api', __name__, url_prefix='/api/v1')
+
+# posts are read as plain rows, no Post or User objects are built for a response
+POST_COLUMNS = (Post.id, Post.body, Post.timestamp, User.username)
+
+
+def isoformat(timestamp):
+    if timestamp is None:
+        return None
+    if timestamp.tzinfo is None:    # stored naive, always UTC
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return timestamp.isoformat()
+
+
+def post_json(row):
+    return {'id': row.id, 'body': row.body, 'timestamp': isoformat(row.timestamp), 'author': row.username}
+
+
+def post_rows(query):
+    return query.with_only_columns(*POST_COLUMNS).join(User, User.id == Post.user_id)
+
+
+def page_limit():
+    limit = request.args.get('limit', current_app.config['POSTS_PER_PAGE'], type=int)
+    if not 0 < limit <= current_app.config['API_MAX_PER_PAGE']:
+        abort(400, f'limit must be between 1 and {current_app.config["API_MAX_PER_PAGE"]}')
+    return limit
+
+
+def post_page(query):
+    limit = page_limit()
+    try:
+        page = keyset_paginate(post_rows(query), limit,
+                               before=request.args.get('before'), after=request.args.get('after'))
+    except ValueError:
+        abort(400, 'Invalid cursor')
+    return jsonify(posts=[post_json(row) for row in page.items], before=page.before, after=page.after)
+
+
+def batch_arg(name, type=str):
+    # ?ids=1,2,3 and ?ids=1&ids=2 are both accepted
+    values = [value for arg in request.args.getlist(name) for value in arg.split(',') if value]
+    if len(values) > current_app.config['API_MAX_BATCH']:
+        abort(400, f'At most {current_app.config["API_MAX_BATCH"]} {name} per request')
+    try:
+        return list(dict.fromkeys(type(value) for value in values))
+    except ValueError:
+        abort(400, f'Invalid {name}')
+
+
+# by code, a blueprint handler for HTTPException would lose to the app-wide HTML 404 page
+@bp.errorhandler(400)
+@bp.errorhandler(404)
+def http_error(error):
+    return jsonify(error=error.name, message=error.description), error.code
+
+
+@bp.before_request
+def before_request():
+    if not current_user.is_authenticated:
+        return jsonify(error='Unauthorized', message='Log in first'), 401
+    last_seen.touch(current_user)
+
+
+@bp.route('/timeline')
+def timeline():
+    try:
+        query = current_user.following_posts(request.args.get('before'), request.args.get('after'),
+                                             page_limit() + 1)
+    except ValueError:
+        abort(400, 'Invalid cursor')
+    return post_page(query)
+
+
+@bp.route('/explore')
+def explore():
+    return post_page(sa.select(Post))
+
+
+@bp.route('/posts')
+def posts():
+    """Many posts by id, in the order asked for; unknown ids are left out."""
+    ids = batch_arg('ids', int)
+    if not ids:
+        return jsonify(posts=[])
+    rows = db.session.execute(post_rows(sa.select(Post)).where(Post.id.in_(ids))).all()
+    by_id = {row.id: row for row in rows}
+    return jsonify(posts=[post_json(by_id[id]) for id in ids if id in by_id])
+
+
+@bp.route('/posts/<int:id>')
+def post(id):
+    row = db.session.execute(post_rows(sa.select(Post)).where(Post.id == id)).first()
+    if row is None:
+        abort(404)
+    return jsonify(post_json(row))
+
+
+@bp.route('/users/<username>')
+def user(username):
+    user = get_user_by_username(username)
+    if user is None:
+        abort(404)
+    return jsonify(
+        username=user.username,
+        about_me=user.about_me,
+        last_seen=isoformat(user.last_seen),
+        avatar=user.avatar(128, external=True),
+        followers=user.num_followers,
+        following=user.num_following,
+        posts=user.num_posts,
+        followed_by_me=user != current_user and current_user.is_following(user),
+    )
+
+
+@bp.route('/users/<username>/posts')
+def user_posts(username):
+    user = get_user_by_username(username)
+    if user is None:
+        abort(404)
+    return post_page(sa.select(Post).where(Post.user_id == user.id))
+
+
+@bp.route('/follow-state')
+def follow_state():
+    """Whether the current user follows each of ?usernames=; unknown usernames are left out."""
+    usernames = batch_arg('usernames')
+    if not usernames:
+        return jsonify(following={})
+    rows = db.session.execute(
+        sa.select(User.username, followers.c.follower_id)
+        .outerjoin(followers, sa.and_(followers.c.followed_id == User.id,
+                                      followers.c.follower_id == current_user.id))
+        .where(User.username.in_(usernames))
+    ).all()
+    return jsonify(following={row.username: row.follower_id is not None for row in rows})
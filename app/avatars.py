@@ -0,0 +1,156 @@
+import os
+import struct
+import tempfile
+import threading
+import zlib
+from collections import OrderedDict
+from flask import Blueprint, current_app, abort
+
+bp = Blueprint('avatars', __name__)
+
+VERSION = 1         # part of every URL, bump when identicon() draws differently
+GRID = 5
+BACKGROUND = (240, 240, 240)
+
+
+def identicon(digest, size):
+    """A GitHub-style identicon for a hex `digest` as PNG bytes.
+
+    A 5x5 grid, mirrored left to right, on a half-cell margin. The first 15
+    nibbles pick the filled cells and the last bytes the colour, so the same
+    email always gets the same picture.
+    """
+    nibbles = [int(c, 16) for c in digest]
+    colour = tuple(64 + byte // 2 for byte in bytes.fromhex(digest[-6:]))
+    half = (GRID + 1) // 2
+    filled = [[False] * GRID for _ in range(GRID)]
+    for i in range(half * GRID):
+        column, row = divmod(i, GRID)
+        if nibbles[i] % 2 == 0:
+            filled[row][column] = filled[row][GRID - 1 - column] = True
+    # pixel -> cell index, with the margin mapped to -1
+    positions = [x * (GRID + 1) / size - 0.5 for x in range(size)]
+    cells = [int(p) if 0 <= p < GRID else -1 for p in positions]
+    lines = []
+    for y in range(size):
+        row = cells[y]
+        if row < 0:
+            lines.append(b'\x00' + bytes(size))
+        else:
+            lines.append(b'\x00' + bytes(1 if column >= 0 and filled[row][column] else 0 for column in cells))
+    return png(size, size, [BACKGROUND, colour], b''.join(lines))
+
+
+def png(width, height, palette, data):
+    # an 8-bit palette PNG; `data` is already filtered, one 0 byte before every row
+    def chunk(kind, body):
+        return struct.pack('>I', len(body)) + kind + body + struct.pack('>I', zlib.crc32(kind + body))
+
+    return (b'\x89PNG\r\n\x1a\n'
+            + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 3, 0, 0, 0))
+            + chunk(b'PLTE', b''.join(bytes(rgb) for rgb in palette))
+            + chunk(b'IDAT', zlib.compress(data, 9))
+            + chunk(b'IEND', b''))
+
+
+class AvatarCache:
+    """Rendered identicons, in a small memory LRU backed by AVATAR_CACHE_DIR.
+
+    An avatar is a pure function of the email digest, size and VERSION, so
+    cached files never need invalidating and responses are immutable. The
+    URL takes any digest, so the directory is capped at AVATAR_DISK_ENTRIES
+    files, removing the oldest first.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()   # (digest, size) -> png bytes
+        self._files = OrderedDict()     # file names in AVATAR_CACHE_DIR, oldest first
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.rendered = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['avatars'] = self
+        self.app = app
+        directory = app.config['AVATAR_CACHE_DIR']
+        files = []
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            files = sorted((entry for entry in os.scandir(directory) if entry.name.endswith('.png')),
+                           key=lambda entry: entry.stat().st_mtime)
+        with self._lock:
+            self._entries.clear()
+            self._files = OrderedDict((entry.name, None) for entry in files)
+        self.memory_hits = self.disk_hits = self.rendered = 0
+
+    def get(self, digest, size):
+        key = (digest, size)
+        with self._lock:
+            data = self._entries.get(key)
+            if data is not None:
+                self._entries.move_to_end(key)
+                self.memory_hits += 1
+                return data
+        directory = self.app.config['AVATAR_CACHE_DIR']
+        name = f'{digest}-{size}-v{VERSION}.png'
+        path = directory and os.path.join(directory, name)
+        data = None
+        if path:
+            try:
+                with open(path, 'rb') as f:
+                    data = f.read()
+                self.disk_hits += 1
+            except FileNotFoundError:
+                pass
+        if data is None:
+            data = identicon(digest, size)
+            self.rendered += 1
+            if path:
+                # write then rename, so a concurrent reader never sees half a file
+                fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp, path)
+                self._evict(directory, name)
+        with self._lock:
+            self._entries[key] = data
+            while len(self._entries) > self.app.config['AVATAR_CACHE_ENTRIES']:
+                self._entries.popitem(last=False)
+        return data
+
+    def _evict(self, directory, name):
+        with self._lock:
+            self._files[name] = None
+            evicted = []
+            while len(self._files) > self.app.config['AVATAR_DISK_ENTRIES']:
+                evicted.append(self._files.popitem(last=False)[0])
+        for old in evicted:
+            try:
+                os.remove(os.path.join(directory, old))
+            except FileNotFoundError:   # another process got there first
+                pass
+
+    def stats(self):
+        return {
+            'entries': len(self._entries),
+            'files': len(self._files),
+            'memory_hits': self.memory_hits,
+            'disk_hits': self.disk_hits,
+            'rendered': self.rendered,
+        }
+
+
+@bp.route(f'/avatar/v{VERSION}/<digest>/<int:size>.png')
+def avatar(digest, size):
+    if size not in current_app.config['AVATAR_SIZES'] or len(digest) != 32 or not all(c in '0123456789abcdef' for c in digest):
+        abort(404)
+    response = current_app.response_class(current_app.extensions['avatars'].get(digest, size),
+                                          mimetype='image/png')
+    response.cache_control.public = True
+    response.cache_control.max_age = 365 * 24 * 3600
+    response.cache_control.immutable = True
+    return response
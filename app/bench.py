@@ -0,0 +1,222 @@
+import json
+import math
+import random
+import statistics
+import subprocess
+import time
+from datetime import datetime, timedelta, timezone
+import click
+import sqlalchemy as sa
+from flask import Blueprint, current_app
+from app import db, search, hasher
+from app.models import User, Post, followers, timeline
+
+bp = Blueprint('bench', __name__, cli_group='bench')
+
+WORDS = ('flask sqlite python post feed follow timeline index query cache page user '
+         'hello world today coffee music travel code bug fix release weekend').split()
+
+
+def seed_dataset(users, posts, follows, alpha=1.2, seed=42, password='bench', chunk_size=10000):
+    """Bulk-insert a synthetic dataset into an empty database.
+
+    Follows and post authorship are drawn from a power law, so a handful of
+    accounts get most of the followers and most of the posts. Every user
+    shares one password hash, which keeps seeding free of hashing cost.
+    """
+    rnd = random.Random(seed)
+    now = datetime.now(timezone.utc)
+    password_hash = hasher.generate(password)
+
+    def popular():
+        # 1-based user id, low ids are much more likely
+        return min(int(rnd.paretovariate(alpha)), users)
+
+    for start in range(1, users + 1, chunk_size):
+        db.session.execute(sa.insert(User), [
+            {'id': i, 'username': f'user{i}', 'email': f'user{i}@example.com',
+             'password_hash': password_hash, 'about_me': f'I am user {i}'}
+            for i in range(start, min(start + chunk_size, users + 1))])
+    for start in range(0, posts, chunk_size):
+        db.session.execute(sa.insert(Post), [
+            {'body': ' '.join(rnd.choices(WORDS, k=rnd.randint(3, 12))), 'user_id': popular(),
+             'timestamp': now - timedelta(seconds=rnd.randint(0, 30 * 24 * 3600))}
+            for _ in range(start, min(start + chunk_size, posts))])
+    edges = []
+    for follower in range(1, users + 1):
+        followed = {popular() for _ in range(max(1, int(rnd.expovariate(1 / follows))))}
+        followed.discard(follower)
+        edges.extend({'follower_id': follower, 'followed_id': id} for id in followed)
+        if len(edges) >= chunk_size:
+            db.session.execute(sa.insert(followers), edges)
+            edges = []
+    if edges:
+        db.session.execute(sa.insert(followers), edges)
+
+    db.session.execute(sa.update(User).values(
+        num_followers=sa.select(sa.func.count()).where(followers.c.followed_id == User.id).scalar_subquery(),
+        num_following=sa.select(sa.func.count()).where(followers.c.follower_id == User.id).scalar_subquery(),
+        num_posts=sa.select(sa.func.count()).where(Post.user_id == User.id).scalar_subquery(),
+    ))
+    # one set-based fan-out instead of replaying every post through Post.fan_out()
+    fanned_out = (
+        sa.select(followers.c.follower_id, Post.timestamp, Post.id)
+        .join(Post, Post.user_id == followers.c.followed_id)
+        .join(User, User.id == followers.c.followed_id)
+        .where(User.num_followers < current_app.config['TIMELINE_CELEBRITY_THRESHOLD'])
+    )
+    db.session.execute(timeline.insert().from_select(['user_id', 'timestamp', 'post_id'], fanned_out))
+    search.reindex(chunk_size)
+    db.session.commit()
+
+
+def percentile(samples, p):
+    ordered = sorted(samples)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+class StatementCounter:
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, conn, cursor, statement, parameters, context, executemany):
+        self.count += 1
+
+
+def run_scenarios(iterations, warmup, password, seed=7):
+    """Time the core routes through the test client.
+
+    Returns {scenario: stats} with latencies in milliseconds and the mean
+    number of SQL statements per request.
+    """
+    app = current_app._get_current_object()
+    app.config['WTF_CSRF_ENABLED'] = False
+    rnd = random.Random(seed)
+    max_id = db.session.scalar(sa.select(sa.func.max(User.id)))
+    client = app.test_client()
+
+    def login_as(id):
+        with client.session_transaction() as sess:
+            sess['_user_id'] = str(id)
+            sess['_fresh'] = True
+
+    def logout():
+        with client.session_transaction() as sess:
+            sess.clear()
+
+    def any_user():
+        return rnd.randint(1, max_id)
+
+    def index():
+        login_as(any_user())
+        return 'GET', '/index', None
+
+    def explore():
+        login_as(any_user())
+        return 'GET', '/explore', None
+
+    def user():
+        login_as(any_user())
+        return 'GET', f'/user/user{any_user()}', None
+
+    def follow():
+        login_as(any_user())
+        return 'POST', f'/follow/user{rnd.randint(2, min(max_id, 200))}', {}
+
+    def unfollow():
+        login_as(any_user())
+        return 'POST', f'/unfollow/user{rnd.randint(2, min(max_id, 200))}', {}
+
+    def login():
+        logout()
+        return 'POST', '/login', {'email': f'user{any_user()}@example.com', 'password': password}
+
+    scenarios = {'index': index, 'explore': explore, 'user': user,
+                 'follow': follow, 'unfollow': unfollow, 'login': login}
+    counter = StatementCounter()
+    results = {}
+    sa.event.listen(db.engine, 'before_cursor_execute', counter)
+    try:
+        for name, prepare in scenarios.items():
+            samples, statements = [], []
+            for i in range(warmup + iterations):
+                method, url, data = prepare()
+                counter.count = 0
+                # a fresh app context per request, otherwise g and the session's
+                # identity map would carry over from the previous request
+                with app.app_context():
+                    start = time.perf_counter()
+                    response = client.open(url, method=method, data=data)
+                    elapsed = (time.perf_counter() - start) * 1000
+                if response.status_code >= 400:
+                    raise click.ClickException(f'{method} {url} returned {response.status_code}')
+                if i >= warmup:
+                    samples.append(elapsed)
+                    statements.append(counter.count)
+            results[name] = {
+                'n': len(samples),
+                'mean': statistics.fmean(samples),
+                'p50': percentile(samples, 50),
+                'p95': percentile(samples, 95),
+                'p99': percentile(samples, 99),
+                'sql_statements': statistics.fmean(statements),
+            }
+    finally:
+        sa.event.remove(db.engine, 'before_cursor_execute', counter)
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+@bp.cli.command('seed')
+@click.option('--users', default=1000, help='Number of users.')
+@click.option('--posts', default=20000, help='Number of posts.')
+@click.option('--follows', default=20, help='Mean number of accounts each user follows.')
+@click.option('--alpha', default=1.2, help='Power-law exponent of popularity.')
+@click.option('--seed', default=42, help='Random seed.')
+@click.option('--password', default='bench', help='Password shared by every seeded user.')
+def seed(users, posts, follows, alpha, seed, password):
+    """Fill an empty database with a synthetic dataset."""
+    if db.session.scalar(sa.select(sa.func.count()).select_from(User)):
+        raise click.ClickException('The database already has users, seed an empty one')
+    start = time.perf_counter()
+    seed_dataset(users, posts, follows, alpha, seed, password)
+    click.echo(f'Seeded {users} users and {posts} posts in {time.perf_counter() - start:.1f}s')
+
+
+@bp.cli.command('run')
+@click.option('--iterations', default=50, help='Timed requests per scenario.')
+@click.option('--warmup', default=5, help='Untimed requests per scenario.')
+@click.option('--password', default='bench', help='Password used by the seed command.')
+@click.option('--output', type=click.Path(dir_okay=False), help='Write results as JSON.')
+@click.option('--compare', type=click.Path(exists=True, dir_okay=False), help='Earlier JSON results to diff against.')
+def run(iterations, warmup, password, output, compare):
+    """Time index, explore, user, follow/unfollow and login on the seeded database."""
+    results = run_scenarios(iterations, warmup, password)
+    baseline = {}
+    if compare:
+        with open(compare) as f:
+            baseline = json.load(f)['scenarios']
+    click.echo(f'{"scenario":<10} {"p50":>9} {"p95":>9} {"p99":>9} {"sql":>6}')
+    for name, stats in results.items():
+        line = (f'{name:<10} {stats["p50"]:7.2f}ms {stats["p95"]:7.2f}ms '
+                f'{stats["p99"]:7.2f}ms {stats["sql_statements"]:6.1f}')
+        if name in baseline:
+            change = (stats['p50'] - baseline[name]['p50']) / baseline[name]['p50'] * 100
+            line += f'  p50 {change:+.1f}%'
+        click.echo(line)
+    if output:
+        with open(output, 'w') as f:
+            json.dump({
+                'revision': git_revision(),
+                'time': datetime.now(timezone.utc).isoformat(),
+                'users': db.session.scalar(sa.select(sa.func.count()).select_from(User)),
+                'posts': db.session.scalar(sa.select(sa.func.count()).select_from(Post)),
+                'scenarios': results,
+            }, f, indent=2)
@@ -0,0 +1,134 @@
+import click
+import sqlalchemy as sa
+from flask import Blueprint, current_app
+from app import db, search, tags
+from app.models import User, Post, followers
+
+bp = Blueprint('cli', __name__, cli_group=None)
+
+
+@bp.cli.group('timeline')
+def timeline_cli():
+    """Home timeline maintenance commands."""
+    pass
+
+
+@timeline_cli.command('rebuild')
+@click.option('--chunk-size', default=100, help='Users rebuilt per transaction.')
+def rebuild(chunk_size):
+    """Rebuild every user's materialized home timeline from the follow graph."""
+    last_id, total = 0, 0
+    while True:
+        users = db.session.scalars(
+            sa.select(User).where(User.id > last_id).order_by(User.id).limit(chunk_size)).all()
+        if not users:
+            break
+        for user in users:
+            user.rebuild_timeline()
+        db.session.commit()
+        last_id = users[-1].id
+        total += len(users)
+        click.echo(f'Rebuilt {total} timelines')
+
+
+@timeline_cli.command('trim')
+@click.option('--chunk-size', default=1000, help='Users trimmed per transaction.')
+def trim(chunk_size):
+    """Cut every timeline down to its TIMELINE_MAX_ROWS newest rows; run it from cron."""
+    last_id, deleted = 0, 0
+    while True:
+        users = db.session.scalars(
+            sa.select(User).where(User.id > last_id).order_by(User.id).limit(chunk_size)).all()
+        if not users:
+            break
+        for user in users:
+            deleted += user.trim_timeline()
+        db.session.commit()
+        last_id = users[-1].id
+    click.echo(f'Deleted {deleted} timeline rows')
+
+
+@bp.cli.group('counters')
+def counters_cli():
+    """Denormalized User counter commands."""
+    pass
+
+
+@counters_cli.command('reconcile')
+@click.option('--chunk-size', default=1000, help='Users checked per transaction.')
+def reconcile(chunk_size):
+    """Recount followers, following and posts and fix drifted User counters."""
+    last_id, fixed = 0, 0
+    while True:
+        ids = db.session.scalars(
+            sa.select(User.id).where(User.id > last_id).order_by(User.id).limit(chunk_size)).all()
+        if not ids:
+            break
+        actual = {id: {'num_followers': 0, 'num_following': 0, 'num_posts': 0} for id in ids}
+        for column, key, table in ((followers.c.followed_id, 'num_followers', followers),
+                                   (followers.c.follower_id, 'num_following', followers),
+                                   (Post.user_id, 'num_posts', Post.__table__)):
+            rows = db.session.execute(
+                sa.select(column, sa.func.count()).select_from(table)
+                .where(column.in_(ids)).group_by(column))
+            for id, count in rows:
+                actual[id][key] = count
+        stored = db.session.execute(
+            sa.select(User.id, User.num_followers, User.num_following, User.num_posts)
+            .where(User.id.in_(ids)))
+        drifted = [dict(actual[row.id], id=row.id) for row in stored
+                   if (row.num_followers, row.num_following, row.num_posts) != tuple(actual[row.id].values())]
+        if drifted:
+            db.session.execute(sa.update(User), drifted)
+        db.session.commit()
+        fixed += len(drifted)
+        last_id = ids[-1]
+    click.echo(f'Fixed counters for {fixed} users')
+
+
+@bp.cli.group('search')
+def search_cli():
+    """Full-text search index commands."""
+    pass
+
+
+@search_cli.command('reindex')
+@click.option('--chunk-size', default=1000, help='Rows read and indexed per batch.')
+def reindex(chunk_size):
+    """Rebuild the search index from every post and user."""
+    search.reindex(chunk_size)
+    db.session.commit()
+    click.echo('Search index rebuilt')
+
+
+@bp.cli.group('tags')
+def tags_cli():
+    """Hashtag index commands."""
+    pass
+
+
+@tags_cli.command('backfill')
+@click.option('--chunk-size', default=1000, help='Posts processed per transaction.')
+def backfill(chunk_size):
+    """Rebuild hashtags and trending counters from every post."""
+    done = 0
+    for done in tags.backfill(chunk_size):
+        click.echo(f'Tagged {done} posts')
+    click.echo(f'Hashtag index rebuilt from {done} posts')
+
+
+@bp.cli.group('templates')
+def templates_cli():
+    """Jinja template commands."""
+    pass
+
+
+@templates_cli.command('precompile')
+def precompile():
+    """Compile every template into TEMPLATE_CACHE_DIR, so workers start with a warm cache."""
+    if not current_app.config['TEMPLATE_CACHE_DIR']:
+        raise click.ClickException('TEMPLATE_CACHE_DIR is not set')
+    names = current_app.jinja_env.list_templates()
+    for name in names:
+        current_app.jinja_env.get_template(name)
+    click.echo(f'Compiled {len(names)} templates into {current_app.config["TEMPLATE_CACHE_DIR"]}')
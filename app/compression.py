@@ -0,0 +1,137 @@
+import threading
+import zlib
+from flask import request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+class GzipStream:
+    encoding = 'gzip'
+
+    def __init__(self, level):
+        # wbits 31: zlib deflate with a gzip header and trailer
+        self._zlib = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        return self._zlib.compress(data)
+
+    def flush(self):
+        # a sync flush ends the current block, so the client can render what it has
+        return self._zlib.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._zlib.flush()
+
+
+class BrotliStream:
+    encoding = 'br'
+
+    def __init__(self, level):
+        self._brotli = brotli.Compressor(quality=level)
+
+    def compress(self, data):
+        return self._brotli.process(data)
+
+    def flush(self):
+        return self._brotli.flush()
+
+    def finish(self):
+        return self._brotli.finish()
+
+
+class Compression:
+    """gzip or brotli for text responses, picked from Accept-Encoding.
+
+    Brotli is offered when the optional brotli package is installed. Bodies
+    below COMPRESS_MIN_SIZE are sent as they are, since the framing would
+    cost more than it saves. Streamed responses are compressed chunk by
+    chunk with a flush after each, so they still arrive incrementally.
+    Compressed responses get a weak ETag: the bytes differ from the
+    identity encoding but the content is the same.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self._lock = threading.Lock()
+        self.compressed = {}    # encoding -> responses
+        self.bytes_in = 0
+        self.bytes_out = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['compression'] = self
+        self.app = app
+        with self._lock:
+            self.bytes_in = self.bytes_out = 0
+            self.compressed = {}
+        app.after_request(self._compress)
+
+    @property
+    def encodings(self):
+        return ('br', 'gzip') if brotli is not None else ('gzip',)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'compressed': dict(self.compressed),
+                'bytes_in': self.bytes_in,
+                'bytes_out': self.bytes_out,
+            }
+
+    def _compress(self, response):
+        config = self.app.config
+        if (not config['COMPRESS_LEVEL'] or response.status_code != 200 or response.direct_passthrough
+                or response.mimetype not in config['COMPRESS_MIMETYPES']
+                or 'Content-Encoding' in response.headers or response.cache_control.no_transform):
+            return response
+        response.vary.add('Accept-Encoding')
+        encoding = request.accept_encodings.best_match(self.encodings)
+        if encoding is None:
+            return response
+        if not response.is_streamed and (response.content_length or 0) < config['COMPRESS_MIN_SIZE']:
+            return response
+        stream = BrotliStream if encoding == 'br' else GzipStream
+        level = config['COMPRESS_BROTLI_QUALITY'] if encoding == 'br' else config['COMPRESS_LEVEL']
+        if response.is_streamed:
+            response.response = self._compress_stream(response.response, stream(level))
+            response.headers.pop('Content-Length', None)
+        else:
+            data = response.get_data()
+            compressor = stream(level)
+            compressed = compressor.compress(data) + compressor.finish()
+            response.set_data(compressed)
+            self._count(encoding, len(data), len(compressed))
+        response.headers['Content-Encoding'] = encoding
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(etag, weak=True)
+        return response
+
+    def _compress_stream(self, chunks, compressor):
+        size_in = size_out = 0
+        try:
+            for chunk in chunks:
+                if isinstance(chunk, str):
+                    chunk = chunk.encode('utf-8')
+                size_in += len(chunk)
+                out = compressor.compress(chunk) + compressor.flush()
+                size_out += len(out)
+                yield out
+            out = compressor.finish()
+            size_out += len(out)
+            yield out
+        finally:
+            close = getattr(chunks, 'close', None)
+            if close is not None:
+                close()
+            self._count(compressor.encoding, size_in, size_out)
+
+    def _count(self, encoding, size_in, size_out):
+        with self._lock:
+            self.compressed[encoding] = self.compressed.get(encoding, 0) + 1
+            self.bytes_in += size_in
+            self.bytes_out += size_out
@@ -0,0 +1,168 @@
+import csv
+import json
+import os
+from datetime import datetime
+import click
+import sqlalchemy as sa
+from flask import Blueprint
+from app import db
+from app.models import User, Post, followers
+from app.search import iter_chunks
+
+bp = Blueprint('data', __name__, cli_group='data')
+
+# in foreign key order, so an import never references a row it hasn't inserted yet
+TABLES = {'users': User.__table__, 'posts': Post.__table__, 'followers': followers}
+FORMATS = ('ndjson', 'csv')
+CHECKPOINT = '.import-checkpoint.json'
+
+
+def encode(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def decode(value, column):
+    if value is None or (value == '' and column.nullable):
+        return None
+    python_type = column.type.python_type
+    if python_type is datetime:
+        return datetime.fromisoformat(value)
+    if python_type is int:
+        return int(value)
+    return value
+
+
+def export_table(table, path, format, chunk_size):
+    names = [column.name for column in table.columns]
+    query = sa.select(*table.columns).order_by(*table.primary_key.columns)
+    count = 0
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = None
+        if format == 'csv':
+            writer = csv.writer(f)
+            writer.writerow(names)
+        for chunk in iter_chunks(query, chunk_size):
+            for row in chunk:
+                values = [encode(value) for value in row]
+                if writer is not None:
+                    writer.writerow(values)
+                else:
+                    f.write(json.dumps(dict(zip(names, values)), ensure_ascii=False) + '\n')
+            count += len(chunk)
+    return count
+
+
+def read_rows(path, format):
+    with open(path, newline='', encoding='utf-8') as f:
+        if format == 'csv':
+            yield from csv.DictReader(f)
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def last_key(table):
+    """The highest primary key in `table`, as a tuple, or None when it is empty."""
+    key = table.primary_key.columns
+    row = db.session.execute(sa.select(*key).order_by(*(column.desc() for column in key)).limit(1)).first()
+    return tuple(row) if row is not None else None
+
+
+def import_table(table, path, format, chunk_size, done, checkpoint, after=None):
+    """Insert the rows of one file in chunks of executemany INSERTs, one commit per chunk.
+
+    The first `done` rows were imported by an earlier run and are skipped,
+    and so are rows up to primary key `after`, which that run may have
+    committed just before it stopped, without reaching their checkpoint.
+    After every commit `checkpoint(rows imported so far)` is called.
+    """
+    columns = {column.name: column for column in table.columns}
+    key = [column.name for column in table.primary_key.columns]
+    chunk, count, inserted = [], 0, 0
+    for count, row in enumerate(read_rows(path, format), 1):
+        if count <= done:
+            continue
+        values = {name: decode(value, columns[name]) for name, value in row.items() if name in columns}
+        if after is not None:
+            if tuple(values[name] for name in key) <= after:
+                continue
+            after = None    # files are written in key order, everything from here on is new
+        chunk.append(values)
+        if len(chunk) >= chunk_size:
+            db.session.execute(table.insert(), chunk)
+            db.session.commit()
+            checkpoint(count)
+            inserted += len(chunk)
+            chunk = []
+    if chunk:
+        db.session.execute(table.insert(), chunk)
+        db.session.commit()
+        inserted += len(chunk)
+    checkpoint(max(count, done))
+    return inserted
+
+
+def reset_sequences():
+    """Move PostgreSQL id sequences past the imported ids, which were inserted explicitly."""
+    if db.engine.dialect.name != 'postgresql':
+        return
+    quote = db.engine.dialect.identifier_preparer.quote
+    for table in TABLES.values():
+        if 'id' in table.primary_key.columns:
+            db.session.execute(sa.text(f"SELECT setval(pg_get_serial_sequence(:table, 'id'), max(id)) "
+                                       f"FROM {quote(table.name)} HAVING max(id) IS NOT NULL"),
+                               {'table': quote(table.name)})
+    db.session.commit()
+
+
+@bp.cli.command('export')
+@click.argument('directory', type=click.Path(file_okay=False))
+@click.option('--format', type=click.Choice(FORMATS), default='ndjson', help='File format.')
+@click.option('--chunk-size', default=1000, help='Rows read per batch.')
+def export(directory, format, chunk_size):
+    """Write users, posts and followers to DIRECTORY, one file per table."""
+    os.makedirs(directory, exist_ok=True)
+    for name, table in TABLES.items():
+        count = export_table(table, os.path.join(directory, f'{name}.{format}'), format, chunk_size)
+        click.echo(f'Exported {count} {name}')
+
+
+@bp.cli.command('import')
+@click.argument('directory', type=click.Path(exists=True, file_okay=False))
+@click.option('--format', type=click.Choice(FORMATS), default='ndjson', help='File format.')
+@click.option('--chunk-size', default=1000, help='Rows inserted per transaction.')
+@click.option('--restart', is_flag=True, help='Ignore the checkpoint of an interrupted import.')
+def import_(directory, format, chunk_size, restart):
+    """Load users, posts and followers from files written by `flask data export`.
+
+    Password hashes are copied as they are, nothing is rehashed. An
+    interrupted import picks up after its last committed chunk when run
+    again. On PostgreSQL the id sequences are moved past the imported ids
+    at the end. Timelines, the search index and hashtags are not part of the
+    export, run `flask timeline rebuild`, `flask search reindex` and
+    `flask tags backfill` afterwards.
+    """
+    checkpoint_path = os.path.join(directory, CHECKPOINT)
+    progress = {}
+    if os.path.exists(checkpoint_path) and not restart:
+        with open(checkpoint_path) as f:
+            progress = json.load(f)
+        click.echo(f'Resuming import after {progress}')
+
+    for name, table in TABLES.items():
+        path = os.path.join(directory, f'{name}.{format}')
+        if not os.path.exists(path):
+            raise click.ClickException(f'{path} not found')
+
+        def checkpoint(done, name=name):
+            progress[name] = done
+            with open(checkpoint_path + '.tmp', 'w') as f:
+                json.dump(progress, f)
+            os.replace(checkpoint_path + '.tmp', checkpoint_path)
+
+        after = last_key(table) if progress else None
+        count = import_table(table, path, format, chunk_size, progress.get(name, 0), checkpoint, after)
+        click.echo(f'Imported {count} {name}')
+    reset_sequences()
+    os.remove(checkpoint_path)
@@ -0,0 +1,76 @@
+import random
+import time
+from flask import has_request_context, request, session, current_app
+from flask_sqlalchemy.session import Session
+import sqlalchemy as sa
+
+READ_METHODS = ('GET', 'HEAD')
+
+
+class RoutingSession(Session):
+    """Sends SELECTs of GET and HEAD requests to a random replica engine.
+
+    Everything else uses the primary: writes, DDL and raw SQL, background
+    threads and the CLI. Once a session has flushed it stays on the primary.
+    The client is also pinned to the primary for DATABASE_READ_YOUR_WRITES
+    seconds, so the page after a POST never reads from a lagging replica.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and clause is not None and getattr(clause, 'is_select', False) and self._can_read_replica():
+            replicas = current_app.extensions['replicas']
+            if replicas:
+                return random.choice(replicas)
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+    def _can_read_replica(self):
+        return (not self.info.get('wrote') and has_request_context() and request.method in READ_METHODS
+                and session.get('_primary_until', 0) < time.time())
+
+
+@sa.event.listens_for(RoutingSession, 'after_flush')
+def pin_to_primary(db_session, flush_context):
+    db_session.info['wrote'] = True
+    # without replicas there is nothing to pin to, and touching the session re-sends its cookie
+    if has_request_context() and current_app.extensions['replicas']:
+        session['_primary_until'] = time.time() + current_app.config['DATABASE_READ_YOUR_WRITES']
+
+
+def configure_pool(app):
+    """Add pool sizing to SQLALCHEMY_ENGINE_OPTIONS, before db.init_app."""
+    if ':memory:' not in app.config['SQLALCHEMY_DATABASE_URI']:     # StaticPool takes no sizing
+        options = dict(app.config.get('SQLALCHEMY_ENGINE_OPTIONS') or {})
+        options.setdefault('pool_size', app.config['DATABASE_POOL_SIZE'])
+        options.setdefault('max_overflow', app.config['DATABASE_MAX_OVERFLOW'])
+        options.setdefault('pool_timeout', app.config['DATABASE_POOL_TIMEOUT'])
+        options.setdefault('pool_pre_ping', True)
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = options
+
+
+def init_replicas(app):
+    # plain engines rather than Flask-SQLAlchemy binds, which would get their own
+    # metadata and tables and be swept up by db.create_all()
+    options = {} if ':memory:' in app.config['SQLALCHEMY_DATABASE_URI'] else app.config['SQLALCHEMY_ENGINE_OPTIONS']
+    app.extensions['replicas'] = [sa.create_engine(uri, **options) for uri in app.config['DATABASE_REPLICA_URIS']]
+
+
+def all_engines(app):
+    from app import db
+
+    with app.app_context():
+        return list(db.engines.values()) + app.extensions['replicas']
+
+
+def tune_sqlite(app):
+    """Run SQLITE_PRAGMAS on every new SQLite connection."""
+    pragmas = app.config['SQLITE_PRAGMAS']
+    for engine in all_engines(app):
+        if engine.dialect.name != 'sqlite' or not pragmas:
+            continue
+
+        @sa.event.listens_for(engine, 'connect')
+        def set_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for name, value in pragmas.items():
+                cursor.execute(f'PRAGMA {name}={value}')
+            cursor.close()
@@ -1,12 +1,12 @@
 from flask_mail import Message
 from flask import current_app, render_template
-from app import mail
+from app import mail_queue
 
 def send_email(subject, sender, recipients, text_body, html_body):
     msg = Message(subject, sender=sender, recipients=recipients)
     msg.body = text_body
     msg.html = html_body
-    mail.send(msg)
+    mail_queue.enqueue(msg)
 
 
 def send_password_reset_email(user):
@@ -1,4 +1,6 @@
 from flask import render_template, Blueprint, current_app
+from werkzeug.exceptions import ServiceUnavailable
+from app.hashing import HashingBusy
 
 bp = Blueprint('errors', __name__)
 
@@ -11,4 +13,8 @@ def internal_error(error):
     with current_app.app_context():
         from app import db
         db.session.rollback()
-    return render_template('500.html'), 500
\ No newline at end of file
+    return render_template('500.html'), 500
+
+@bp.app_errorhandler(HashingBusy)
+def hashing_busy(error):
+    return ServiceUnavailable(retry_after=5).get_response()
@@ -0,0 +1,110 @@
+import sys
+import threading
+from collections import OrderedDict
+from flask import render_template
+from markupsafe import Markup
+import sqlalchemy as sa
+
+
+class FragmentCache:
+    """LRU cache of rendered _post.html rows, capped at POST_CACHE_MAX_BYTES.
+
+    Entries are keyed by post id and the author's version, which is bumped
+    whenever the author's username changes, so a stale row is never served.
+    """
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()   # key -> rendered Markup
+        self._by_post = {}              # post id -> keys
+        self._by_author = {}            # author id -> keys
+        self._versions = {}             # author id -> version
+        self.max_bytes = 0
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        from app.models import Post
+
+        app.extensions['fragments'] = self
+        app.add_template_global(self.render_post, 'render_post')
+        self.max_bytes = app.config['POST_CACHE_MAX_BYTES']
+        self.clear()
+        if not sa.event.contains(Post, 'after_update', self._post_updated):
+            sa.event.listen(Post, 'after_update', self._post_updated)
+
+    def render_post(self, post):
+        author = post.author
+        key = (post.id, author.id, self._versions.get(author.id, 0), author.username)
+        with self._lock:
+            html = self._entries.get(key)
+            if html is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return html
+            self.misses += 1
+        html = Markup(render_template('_post.html', post=post))
+        if self.max_bytes:
+            self._store(key, html)
+        return html
+
+    def invalidate_post(self, post_id):
+        with self._lock:
+            for key in list(self._by_post.get(post_id, ())):
+                self._remove(key)
+
+    def invalidate_user(self, user_id):
+        with self._lock:
+            self._versions[user_id] = self._versions.get(user_id, 0) + 1
+            for key in list(self._by_author.get(user_id, ())):
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._by_post.clear()
+            self._by_author.clear()
+            self.bytes = self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+            }
+
+    def _store(self, key, html):
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = html
+            self._by_post.setdefault(key[0], set()).add(key)
+            self._by_author.setdefault(key[1], set()).add(key)
+            self.bytes += sys.getsizeof(html)
+            while self.bytes > self.max_bytes and self._entries:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        html = self._entries.pop(key, None)
+        if html is None:
+            return
+        self.bytes -= sys.getsizeof(html)
+        for index, id in ((self._by_post, key[0]), (self._by_author, key[1])):
+            keys = index.get(id)
+            keys.discard(key)
+            if not keys:
+                del index[id]
+
+    def _post_updated(self, mapper, connection, post):
+        self.invalidate_post(post.id)
@@ -0,0 +1,267 @@
+import heapq
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from bisect import bisect_left
+import sqlalchemy as sa
+import sqlalchemy.orm as saorm
+
+
+class FollowGraph:
+    """In-memory copy of the followers table in CSR form.
+
+    offsets[u]:offsets[u + 1] is the slice of targets holding the sorted ids
+    user u follows, so an edge lookup is one bisect and the whole graph
+    costs a few bytes per edge. Follows and unfollows committed by this
+    process go into small overlay sets and are folded into the arrays once
+    GRAPH_COMPACT_THRESHOLD of them pile up. Changes made by other
+    processes show up on the next reload, every GRAPH_MAX_AGE seconds; it
+    runs in a background thread while the old arrays keep serving.
+    That lag is fine for suggestions, so follow state that users see is
+    still read from SQL.
+    """
+
+    POPULAR = 50
+
+    def __init__(self, app=None):
+        self.app = None
+        self._lock = threading.RLock()
+        self._load_lock = threading.RLock()     # one load at a time
+        self._reset()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['graph'] = self
+        self.app = app
+        with self._lock:
+            self._reset()
+        if not sa.event.contains(saorm.Session, 'after_commit', self._after_commit):
+            sa.event.listen(saorm.Session, 'after_commit', self._after_commit)
+            sa.event.listen(saorm.Session, 'after_soft_rollback', self._after_rollback)
+
+    def _reset(self):
+        self.offsets = array('q', [0])
+        self.targets = array('i')
+        self.in_degree = array('i')
+        self._added = {}        # follower -> ids followed since the last build
+        self._removed = {}      # follower -> ids unfollowed since the last build
+        self._overlay = 0
+        self._popular = []      # most followed ids as of the last build
+        self._pending = None    # edges committed while a load runs, replayed onto its arrays
+        self._reloading = False
+        self._suggested = OrderedDict()     # user id -> (expires at, limit, suggestions)
+        self._built = None
+        self.builds = 0
+        self.suggestion_hits = 0
+
+    def load(self, chunk_size=10000):
+        """Rebuild the arrays from the followers table.
+
+        Follows and unfollows committed while it reads are replayed onto the
+        new arrays, whether or not the read already saw them.
+        """
+        with self._load_lock:
+            with self._lock:
+                self._pending = []
+            try:
+                self._load(chunk_size)
+            finally:
+                with self._lock:
+                    self._pending = None
+
+    def _load(self, chunk_size):
+        from app import db
+        from app.models import followers
+        from app.search import iter_chunks
+
+        max_id = db.session.scalar(sa.select(sa.func.max(followers.c.follower_id))) or 0
+        max_followed = db.session.scalar(sa.select(sa.func.max(followers.c.followed_id))) or 0
+        offsets = array('q', bytes(8 * (max_id + 2)))
+        targets = array('i')
+        in_degree = array('i', bytes(4 * (max(max_id, max_followed) + 1)))
+        query = sa.select(followers.c.follower_id, followers.c.followed_id).order_by(
+            followers.c.follower_id, followers.c.followed_id)
+        for chunk in iter_chunks(query, chunk_size):
+            for follower, followed in chunk:
+                offsets[follower + 1] += 1
+                targets.append(followed)
+                in_degree[followed] += 1
+        for i in range(1, len(offsets)):
+            offsets[i] += offsets[i - 1]
+        popular = heapq.nlargest(self.POPULAR, (id for id in range(len(in_degree)) if in_degree[id]),
+                                 key=lambda id: (in_degree[id], -id))
+        with self._lock:
+            self.offsets, self.targets, self.in_degree = offsets, targets, in_degree
+            self._popular = popular
+            self._added, self._removed, self._overlay = {}, {}, 0
+            for edge in self._pending:
+                self._set_edge(*edge)
+            self._built = time.monotonic()
+            self.builds += 1
+
+    def is_following(self, follower, followed):
+        self._ensure_fresh()
+        with self._lock:
+            if followed in self._added.get(follower, ()):
+                return True
+            if followed in self._removed.get(follower, ()):
+                return False
+            return self._in_arrays(follower, followed)
+
+    def following(self, follower):
+        """Ids `follower` follows, sorted."""
+        self._ensure_fresh()
+        with self._lock:
+            ids = set(self._row(follower))
+            ids |= self._added.get(follower, set())
+            ids -= self._removed.get(follower, set())
+        return sorted(ids)
+
+    def suggestions(self, user_id, limit):
+        """suggest() for one user, cached for SUGGESTIONS_CACHE_SECONDS."""
+        now = time.monotonic()
+        with self._lock:
+            cached = self._suggested.get(user_id)
+            if cached is not None and cached[0] > now and cached[1] == limit:
+                self._suggested.move_to_end(user_id)
+                self.suggestion_hits += 1
+                return cached[2]
+        result = self.suggest([user_id], limit)[user_id]
+        with self._lock:
+            self._suggested[user_id] = (now + self.app.config['SUGGESTIONS_CACHE_SECONDS'], limit, result)
+            self._suggested.move_to_end(user_id)
+            while len(self._suggested) > self.app.config['SUGGESTIONS_CACHE_ENTRIES']:
+                self._suggested.popitem(last=False)
+        return result
+
+    def suggest(self, user_ids, limit):
+        """Who to follow for each of `user_ids`: {user id: [(candidate id, mutual count)]}.
+
+        Candidates are the accounts followed by the accounts a user follows,
+        ranked by how many of those follow them, then by total followers.
+        A user who follows nobody gets the most followed accounts.
+        """
+        self._ensure_fresh()
+        suggestions = {}
+        for user_id in user_ids:
+            followed = self.following(user_id)
+            scores = {}
+            for middle in followed:
+                for candidate in self.following(middle):
+                    scores[candidate] = scores.get(candidate, 0) + 1
+            if not followed:
+                scores = {candidate: 0 for candidate in self._popular[:limit + 1]}
+            excluded = set(followed)
+            excluded.add(user_id)
+            with self._lock:
+                in_degree = self.in_degree
+                ranked = heapq.nsmallest(
+                    limit, (candidate for candidate in scores if candidate not in excluded),
+                    key=lambda c: (-scores[c], -(in_degree[c] if c < len(in_degree) else 0), c))
+            suggestions[user_id] = [(candidate, scores[candidate]) for candidate in ranked]
+        return suggestions
+
+    def stats(self):
+        with self._lock:
+            return {
+                'nodes': len(self.offsets) - 1,
+                'edges': len(self.targets),
+                'overlay': self._overlay,
+                'builds': self.builds,
+                'suggestions_cached': len(self._suggested),
+                'suggestion_hits': self.suggestion_hits,
+                'bytes': (self.offsets.itemsize * len(self.offsets) + self.targets.itemsize * len(self.targets)
+                          + self.in_degree.itemsize * len(self.in_degree)),
+                'age': time.monotonic() - self._built if self._built is not None else None,
+            }
+
+    def record(self, session, follower, followed, following):
+        # applied once the session commits, see _after_commit
+        session.info.setdefault('graph_edges', []).append((follower, followed, following))
+
+    def _apply(self, follower, followed, following):
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append((follower, followed, following))
+            self._suggested.pop(follower, None)
+            if self._built is None:
+                return      # the first load reads it from the database
+            self._set_edge(follower, followed, following)
+            if self._overlay >= self.app.config['GRAPH_COMPACT_THRESHOLD']:
+                self._compact()
+
+    def _set_edge(self, follower, followed, following):
+        # a no-op when the edge is already in that state, so replaying an edge the load saw is harmless
+        in_arrays = self._in_arrays(follower, followed)
+        current = followed in self._added.get(follower, ()) or (
+            in_arrays and followed not in self._removed.get(follower, ()))
+        if current == following:
+            return
+        if following:
+            self._removed.get(follower, set()).discard(followed)
+            if not in_arrays:
+                self._added.setdefault(follower, set()).add(followed)
+        else:
+            self._added.get(follower, set()).discard(followed)
+            if in_arrays:
+                self._removed.setdefault(follower, set()).add(followed)
+        if followed >= len(self.in_degree):
+            self.in_degree.extend(array('i', bytes(4 * (followed + 1 - len(self.in_degree)))))
+        self.in_degree[followed] += 1 if following else -1
+        self._overlay += 1
+
+    def _compact(self):
+        # fold the overlay into fresh arrays without going back to the database
+        size = max([len(self.offsets) - 1, *(id + 1 for id in self._added)])
+        offsets, targets = array('q', [0]), array('i')
+        for follower in range(size):
+            row = self._row(follower)
+            added, removed = self._added.get(follower), self._removed.get(follower)
+            if added or removed:
+                row = sorted(set(row).union(added or ()).difference(removed or ()))
+            targets.extend(row)
+            offsets.append(len(targets))
+        self.offsets, self.targets = offsets, targets
+        self._added, self._removed, self._overlay = {}, {}, 0
+
+    def _row(self, follower):
+        if follower + 1 >= len(self.offsets):
+            return self.targets[0:0]
+        return self.targets[self.offsets[follower]:self.offsets[follower + 1]]
+
+    def _in_arrays(self, follower, followed):
+        if follower + 1 >= len(self.offsets):
+            return False
+        lo, hi = self.offsets[follower], self.offsets[follower + 1]
+        i = bisect_left(self.targets, followed, lo, hi)
+        return i < hi and self.targets[i] == followed
+
+    def _ensure_fresh(self):
+        if self._built is None:
+            with self._load_lock:   # the first caller loads, the others wait for it
+                if self._built is None:
+                    self.load()
+        elif time.monotonic() - self._built > self.app.config['GRAPH_MAX_AGE']:
+            with self._lock:
+                if self._reloading:
+                    return
+                self._reloading = True
+            threading.Thread(target=self._reload, name='graph-reload', daemon=True).start()
+
+    def _reload(self):
+        try:
+            with self.app.app_context():
+                self.load()
+        except Exception:
+            self.app.logger.exception('Failed to reload the follow graph')
+        finally:
+            self._reloading = False
+
+    def _after_commit(self, session):
+        for edge in session.info.pop('graph_edges', ()):
+            self._apply(*edge)
+
+    def _after_rollback(self, session, previous_transaction):
+        session.info.pop('graph_edges', None)
@@ -0,0 +1,107 @@
+import atexit
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from werkzeug.security import generate_password_hash, check_password_hash
+
+
+class HashingBusy(Exception):
+    """No hashing slot freed up within PASSWORD_HASH_TIMEOUT seconds."""
+
+
+class PasswordHasher:
+    """Runs werkzeug password hashing in a process pool.
+
+    Hashing is CPU-bound on purpose, so with PASSWORD_HASH_WORKERS > 0 it
+    runs in worker processes and request threads only wait. At most
+    PASSWORD_HASH_MAX_PENDING hashes are queued or running; a caller that
+    can't get a slot in time gets HashingBusy instead of joining an
+    unbounded backlog. With 0 workers hashing runs inline. Workers are
+    started by a forkserver (spawn where that is missing), since forking a
+    process that already runs request threads can copy held locks.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self._lock = threading.Lock()
+        self._pool = None
+        self._slots = None
+        self._prefix = None
+        self.hashes = 0
+        self.checks = 0
+        self.rehashes = 0
+        self.rejected = 0
+        self.total_ms = 0.0
+        atexit.register(self.shutdown)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['hasher'] = self
+        self.shutdown()
+        self.app = app
+        self._slots = threading.BoundedSemaphore(app.config['PASSWORD_HASH_MAX_PENDING'])
+        self._prefix = None
+        self.hashes = self.checks = self.rehashes = self.rejected = 0
+        self.total_ms = 0.0
+
+    @property
+    def method(self):
+        return self.app.config['PASSWORD_HASH_METHOD']
+
+    def generate(self, password):
+        self.hashes += 1
+        return self._run(generate_password_hash, password, self.method)
+
+    def check(self, pwhash, password):
+        self.checks += 1
+        return self._run(check_password_hash, pwhash, password)
+
+    def needs_rehash(self, pwhash):
+        """Whether `pwhash` was made with another method or cost than the configured one."""
+        if self._prefix is None:
+            # werkzeug fills in defaults ('scrypt' -> 'scrypt:32768:8:1'), hash once to learn them
+            self._prefix = generate_password_hash('', self.method).split('$', 1)[0]
+        return pwhash.split('$', 1)[0] != self._prefix
+
+    def stats(self):
+        calls = self.hashes + self.checks
+        return {
+            'workers': self.app.config['PASSWORD_HASH_WORKERS'],
+            'method': self.method,
+            'hashes': self.hashes,
+            'checks': self.checks,
+            'rehashes': self.rehashes,
+            'rejected': self.rejected,
+            'mean_ms': self.total_ms / calls if calls else 0.0,
+        }
+
+    def shutdown(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    def _run(self, func, *args):
+        from app import perf
+
+        if not self._slots.acquire(timeout=self.app.config['PASSWORD_HASH_TIMEOUT']):
+            self.rejected += 1
+            raise HashingBusy()
+        start = time.perf_counter()
+        try:
+            workers = self.app.config['PASSWORD_HASH_WORKERS']
+            if not workers:
+                return func(*args)
+            with self._lock:
+                if self._pool is None:
+                    method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+                    self._pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(method))
+                pool = self._pool
+            return pool.submit(func, *args).result()
+        finally:
+            self._slots.release()
+            elapsed = (time.perf_counter() - start) * 1000
+            self.total_ms += elapsed
+            perf.record('hash', elapsed)
@@ -0,0 +1,188 @@
+import atexit
+import email.utils
+import json
+import logging
+import os
+import queue
+import smtplib
+import threading
+import time
+from email.message import EmailMessage
+from logging.handlers import SMTPHandler, RotatingFileHandler, MemoryHandler, QueueHandler, QueueListener
+from flask.logging import default_handler
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'path': record.pathname,
+            'line': record.lineno,
+        }
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class BufferedHandler(MemoryHandler):
+    """MemoryHandler that also flushes once flush_interval seconds have passed."""
+
+    def __init__(self, capacity, target, flush_interval):
+        super().__init__(capacity, flushLevel=logging.ERROR, target=target)
+        self.flush_interval = flush_interval
+        self.last_flush = time.monotonic()
+
+    def shouldFlush(self, record):
+        return super().shouldFlush(record) or time.monotonic() - self.last_flush >= self.flush_interval
+
+    def flush(self):
+        super().flush()
+        self.last_flush = time.monotonic()
+
+    def due_in(self):
+        """Seconds until the interval flush is due, zero or less once it is."""
+        return self.last_flush + self.flush_interval - time.monotonic()
+
+
+class FlushingQueueListener(QueueListener):
+    """QueueListener that flushes BufferedHandlers on their interval while the queue is idle.
+
+    shouldFlush() only runs when a record arrives, so without this a lone
+    record would sit in the buffer until the next ones or process exit.
+    """
+
+    def dequeue(self, block):
+        buffered = [handler for handler in self.handlers if isinstance(handler, BufferedHandler)]
+        while True:
+            timeout = min((handler.due_in() for handler in buffered), default=None) if block else None
+            try:
+                return self.queue.get(block, None if timeout is None else max(timeout, 0.01))
+            except queue.Empty:
+                if not block:
+                    raise
+            for handler in buffered:
+                if handler.due_in() <= 0:
+                    handler.flush()
+
+
+class DigestSMTPHandler(SMTPHandler):
+    """Collects error records and mails them as one deduplicated digest.
+
+    The first record of a burst waits `delay` seconds for the rest of the
+    burst, and digests go out at most once every `interval` seconds.
+    """
+
+    def __init__(self, *args, interval=300, delay=10, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.interval = interval
+        self.delay = delay
+        self.pending = {}   # dedup key -> [count, first record]
+        self.last_sent = None
+        self.timer = None
+
+    def emit(self, record):
+        lines = record.getMessage().strip().splitlines() or ['']
+        key = (record.levelname, record.pathname, record.lineno, lines[0], lines[-1])
+        if key in self.pending:
+            self.pending[key][0] += 1
+        else:
+            self.pending[key] = [1, record]
+        if self.timer is None:
+            wait = self.delay
+            if self.last_sent is not None:
+                wait = max(wait, self.last_sent + self.interval - time.monotonic())
+            self.timer = threading.Timer(wait, self.flush)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def flush(self):
+        self.acquire()
+        try:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            pending, self.pending = self.pending, {}
+            if pending:
+                self.last_sent = time.monotonic()
+        finally:
+            self.release()
+        if pending:
+            self.send_digest(list(pending.values()))
+
+    def send_digest(self, entries):
+        total = sum(count for count, _ in entries)
+        body = '\n\n'.join(f'[{count}x] {self.format(record)}' for count, record in entries)
+        msg = EmailMessage()
+        msg['From'] = self.fromaddr
+        msg['To'] = ','.join(self.toaddrs)
+        msg['Subject'] = f'{self.subject} ({total} errors)'
+        msg['Date'] = email.utils.localtime()
+        msg.set_content(body)
+        try:
+            smtp = smtplib.SMTP(self.mailhost, self.mailport or smtplib.SMTP_PORT, timeout=self.timeout)
+            if self.username:
+                if self.secure is not None:
+                    smtp.ehlo()
+                    smtp.starttls(*self.secure)
+                    smtp.ehlo()
+                smtp.login(self.username, self.password)
+            smtp.send_message(msg)
+            smtp.quit()
+        except Exception:
+            self.handleError(entries[0][1])
+
+    def close(self):
+        self.flush()
+        super().close()
+
+
+def init_logging(app):
+    """Route app.logger through a queue so request threads never do log I/O.
+
+    A background QueueListener feeds a buffered, JSON-formatted rotating file,
+    flushed at least every LOG_FLUSH_INTERVAL seconds, and, when MAIL_SERVER
+    is set, the error digest mailer.
+    """
+    handlers = []
+    if app.config['MAIL_SERVER']:
+        auth = None
+        if app.config['MAIL_USERNAME'] or app.config['MAIL_PASSWORD']:
+            auth = (app.config['MAIL_USERNAME'], app.config['MAIL_PASSWORD'])
+        secure = None
+        if app.config['MAIL_USE_TLS']:
+            secure = ()
+        mail_handler = DigestSMTPHandler(
+            mailhost=(app.config['MAIL_SERVER'], app.config['MAIL_PORT']),
+            fromaddr='no-reply@' + app.config['MAIL_SERVER'],
+            toaddrs=app.config['ADMINS'],
+            subject='FAIL IN BLOGAPP',
+            credentials=auth,
+            secure=secure,
+            interval=app.config['LOG_MAIL_INTERVAL'],
+            delay=app.config['LOG_MAIL_DELAY']
+        )
+        mail_handler.setLevel(logging.ERROR)
+        mail_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]'))
+        handlers.append(mail_handler)
+
+    log_dir = os.path.dirname(app.config['LOG_FILE'])
+    if log_dir and not os.path.exists(log_dir):
+        os.mkdir(log_dir)
+    file_handler = RotatingFileHandler(app.config['LOG_FILE'], maxBytes=10240, backupCount=10)
+    file_handler.setFormatter(JsonFormatter())
+    buffered = BufferedHandler(app.config['LOG_BUFFER_CAPACITY'], file_handler,
+                               app.config['LOG_FLUSH_INTERVAL'])
+    buffered.setLevel(logging.INFO)
+    handlers.append(buffered)
+
+    log_queue = queue.SimpleQueue()
+    listener = FlushingQueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    app.logger.removeHandler(default_handler)     # stderr writes would block request threads again
+    app.logger.addHandler(QueueHandler(log_queue))
+    app.logger.setLevel(logging.INFO)
+    return listener
@@ -0,0 +1,183 @@
+import atexit
+import json
+import os
+import queue
+import threading
+import time
+from datetime import datetime, timezone
+
+
+class SMTPSink:
+    """Delivers through flask_mail, keeping one SMTP connection open per worker."""
+
+    def __init__(self, app):
+        self.app = app
+        self.connection = None
+
+    def send(self, msg):
+        if self.connection is None:
+            self.connection = self.app.extensions['mail'].connect()
+            self.connection.__enter__()
+        self.connection.send(msg)
+
+    def close(self):
+        if self.connection is not None:
+            connection, self.connection = self.connection, None
+            try:
+                connection.__exit__(None, None, None)
+            except Exception:
+                pass
+
+
+class MemorySink:
+    """Keeps delivered messages in MailQueue.outbox, for tests and benchmarks."""
+
+    def __init__(self, app):
+        self.outbox = app.extensions['mail_queue'].outbox
+
+    def send(self, msg):
+        self.outbox.append(msg)
+
+    def close(self):
+        pass
+
+
+class FileSink:
+    """Writes every message as an .eml file into MAIL_SINK_DIR."""
+
+    def __init__(self, app):
+        self.directory = app.config['MAIL_SINK_DIR']
+        os.makedirs(self.directory, exist_ok=True)
+
+    def send(self, msg):
+        name = f'{time.time_ns()}-{threading.get_ident()}.eml'
+        with open(os.path.join(self.directory, name), 'wb') as f:
+            f.write(msg.as_bytes())
+
+    def close(self):
+        pass
+
+
+SINKS = {'smtp': SMTPSink, 'memory': MemorySink, 'file': FileSink}
+
+
+class MailQueue:
+    """Bounded outgoing mail queue drained by a pool of worker threads.
+
+    Workers keep their sink (an SMTP connection for the default sink) open
+    while there is work and close it after MAIL_IDLE_TIMEOUT seconds idle.
+    Failed sends are retried with exponential backoff; messages that still
+    fail, or that don't fit in the queue, go to the dead-letter log.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.outbox = []
+        self._queue = None
+        self._workers = []
+        self._lock = threading.Lock()
+        self.sent = 0
+        self.retried = 0
+        self.dead = 0
+        atexit.register(self.shutdown)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['mail_queue'] = self
+        self.app = app
+        self._queue = queue.Queue(maxsize=app.config['MAIL_QUEUE_SIZE'])
+        self._workers = []
+        self.outbox.clear()
+        self.sent = self.retried = self.dead = 0
+
+    def enqueue(self, msg):
+        self._ensure_workers()
+        try:
+            self._queue.put(msg, timeout=self.app.config['MAIL_ENQUEUE_TIMEOUT'])
+        except queue.Full:
+            self._dead_letter(msg, 'mail queue is full')
+            return False
+        return True
+
+    def join(self):
+        """Block until every queued message was delivered or dead-lettered."""
+        self._queue.join()
+
+    def shutdown(self):
+        if self.app is None or not self._workers:
+            return
+        self._queue.join()
+        for _ in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+
+    def stats(self):
+        return {
+            'queued': self._queue.qsize() if self._queue is not None else 0,
+            'sent': self.sent,
+            'retried': self.retried,
+            'dead': self.dead,
+        }
+
+    def _ensure_workers(self):
+        with self._lock:
+            if self._workers:
+                return
+            for i in range(self.app.config['MAIL_WORKERS']):
+                worker = threading.Thread(target=self._run, name=f'mail-worker-{i}', daemon=True)
+                worker.start()
+                self._workers.append(worker)
+
+    def _run(self):
+        app = self.app
+        with app.app_context():
+            sink = SINKS[app.config['MAIL_SINK']](app)
+            while True:
+                try:
+                    msg = self._queue.get(timeout=app.config['MAIL_IDLE_TIMEOUT'])
+                except queue.Empty:
+                    sink.close()
+                    continue
+                if msg is None:
+                    self._queue.task_done()
+                    break
+                try:
+                    self._deliver(sink, msg)
+                finally:
+                    self._queue.task_done()
+            sink.close()
+
+    def _deliver(self, sink, msg):
+        retries = self.app.config['MAIL_MAX_RETRIES']
+        for attempt in range(retries + 1):
+            try:
+                sink.send(msg)
+            except Exception as e:
+                sink.close()
+                if attempt == retries:
+                    self._dead_letter(msg, repr(e))
+                    return
+                with self._lock:
+                    self.retried += 1
+                time.sleep(self.app.config['MAIL_RETRY_BACKOFF'] * 2 ** attempt)
+            else:
+                with self._lock:
+                    self.sent += 1
+                return
+
+    def _dead_letter(self, msg, error):
+        with self._lock:
+            self.dead += 1
+            path = self.app.config['MAIL_DEAD_LETTER_LOG']
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            with open(path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps({
+                    'time': datetime.now(timezone.utc).isoformat(),
+                    'subject': msg.subject,
+                    'recipients': msg.recipients,
+                    'error': error,
+                }) + '\n')
+        self.app.logger.error('Dead-lettered email %r to %s: %s', msg.subject, msg.recipients, error)
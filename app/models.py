@@ -4,21 +4,46 @@ import typing
 import sqlalchemy as sa
 import sqlalchemy.orm as saorm
 import jwt
-from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import UserMixin
 from hashlib import md5
-from flask import current_app
+from flask import current_app, g, url_for
 
-from app import db, login
+from app import db, login, hasher, user_cache, graph
 
 
 followers = sa.Table(
     'followers',
     db.metadata,
     sa.Column('follower_id', sa.Integer, sa.ForeignKey('user.id'), primary_key=True),
-    sa.Column('followed_id', sa.Integer, sa.ForeignKey('user.id'), primary_key=True)
+    sa.Column('followed_id', sa.Integer, sa.ForeignKey('user.id'), primary_key=True),
+    sa.Index('ix_followers_followed_id_follower_id', 'followed_id', 'follower_id')  # "who follows X"
 )   # auxiliary table, it has no data other then foreign keys, saorm there is no need to make a model class
 
+timeline = sa.Table(
+    'timeline',
+    db.metadata,
+    sa.Column('user_id', sa.Integer, sa.ForeignKey('user.id'), primary_key=True),
+    sa.Column('timestamp', sa.DateTime, primary_key=True),
+    sa.Column('post_id', sa.Integer, sa.ForeignKey('post.id'), primary_key=True)
+)   # materialized home feed: one row per (reader, post), filled on write by Post.fan_out()
+
+post_tag = sa.Table(
+    'post_tag',
+    db.metadata,
+    sa.Column('tag', sa.String(64), primary_key=True),
+    sa.Column('timestamp', sa.DateTime, primary_key=True),
+    sa.Column('post_id', sa.Integer, sa.ForeignKey('post.id'), primary_key=True)
+)   # hashtags, one row per (tag, post), filled by TagIndex.add_post(); laid out like timeline
+
+tag_count = sa.Table(
+    'tag_count',
+    db.metadata,
+    sa.Column('tag', sa.String(64), primary_key=True),
+    sa.Column('bucket', sa.Integer, primary_key=True),
+    sa.Column('count', sa.Integer, nullable=False),
+    sa.Index('ix_tag_count_bucket', 'bucket')
+)   # posts per tag and TRENDING_BUCKET-second time bucket, for trending topics
+
 class User(UserMixin, db.Model):
     id: saorm.Mapped[int] = saorm.mapped_column(primary_key=True)
     username: saorm.Mapped[str] = saorm.mapped_column(sa.String(64), index=True, unique=True)
@@ -26,6 +51,10 @@ class User(UserMixin, db.Model):
     password_hash: saorm.Mapped[typing.Optional[str]] = saorm.mapped_column(sa.String(256))
     about_me: saorm.Mapped[typing.Optional[str]] = saorm.mapped_column(sa.String(140))
     last_seen: saorm.Mapped[typing.Optional[datetime]] = saorm.mapped_column(default=lambda: datetime.now(timezone.utc))
+    # denormalized counters, kept in step by follow/unfollow and post creation, see `flask counters reconcile`
+    num_followers: saorm.Mapped[int] = saorm.mapped_column(default=0, server_default='0')
+    num_following: saorm.Mapped[int] = saorm.mapped_column(default=0, server_default='0')
+    num_posts: saorm.Mapped[int] = saorm.mapped_column(default=0, server_default='0')
 
     posts: saorm.WriteOnlyMapped['Post'] = saorm.relationship(back_populates='author')
     
@@ -42,51 +71,170 @@ class User(UserMixin, db.Model):
         return '<User {}>'.format(self.username)
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = hasher.generate(password)
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        # on success a hash made with outdated parameters is replaced, the caller commits
+        if not self.password_hash or not hasher.check(self.password_hash, password):
+            return False
+        if hasher.needs_rehash(self.password_hash):
+            self.set_password(password)
+            hasher.rehashes += 1
+        return True
+
+    @property
+    def avatar_digest(self):
+        # memoized per instance, a feed page asks for it once per post row
+        cached = self.__dict__.get('_avatar_digest')
+        if cached is None or cached[0] != self.email:
+            cached = self.email, md5(self.email.lower().encode('utf-8')).hexdigest()
+            self.__dict__['_avatar_digest'] = cached
+        return cached[1]
 
-    def avatar(self, size):
-        digest = md5(self.email.lower().encode('utf-8')).hexdigest()
-        return f'https://www.gravatar.com/avatar/{digest}?d=identicon&s={size}'
+    def avatar(self, size, external=False):
+        if current_app.config['AVATAR_PROVIDER'] == 'gravatar':
+            return f'https://www.gravatar.com/avatar/{self.avatar_digest}?d=identicon&s={size}'
+        return url_for('avatars.avatar', digest=self.avatar_digest, size=size, _external=external)
 
     def follow(self, user):
         if not self.is_following(user):
             self.following.add(user)
+            self.num_following = User.num_following + 1
+            user.num_followers = User.num_followers + 1
+            db.session.flush()
+            self.backfill_timeline(user)
+            graph.record(db.session, self.id, user.id, following=True)
 
     def unfollow(self, user):
         if self.is_following(user):
             self.following.remove(user)
+            self.num_following = User.num_following - 1
+            user.num_followers = User.num_followers - 1
+            self.prune_timeline(user)
+            graph.record(db.session, self.id, user.id, following=False)
+            db.session.flush()
+            if user.followers_count() == current_app.config['TIMELINE_CELEBRITY_THRESHOLD'] - 1:
+                user.fan_out_recent()
 
     def is_following(self, user):
         query = self.following.select().where(User.id == user.id)
         return db.session.scalar(query) is not None
 
     def followers_count(self):
-        query = sa.select(sa.func.count()).select_from(
-            self.followers.select().subquery())
-        return db.session.scalar(query)
+        return self.num_followers
 
     def following_count(self):
-        query = sa.select(sa.func.count()).select_from(
-            self.following.select().subquery())
-        return db.session.scalar(query)
+        return self.num_following
 
-    def following_posts(self):
-        Author = saorm.aliased(User)
-        Follower = saorm.aliased(User)
+    def posts_count(self):
+        return self.num_posts
+
+    def is_celebrity(self):
+        return self.followers_count() >= current_app.config['TIMELINE_CELEBRITY_THRESHOLD']
+
+    def following_posts(self, before=None, after=None, limit=None):
+        """Home feed, newest first.
+
+        A hybrid read: fanned-out posts from the timeline table, plus own
+        posts and posts of celebrities, which are never fanned out and are
+        pulled here instead. Each source is read in the order of its own
+        index, timeline by primary key and every author on
+        ix_post_user_id_timestamp, with the keyset cursor and `limit` of the
+        page about to be read pushed into it. A page then costs at most
+        `limit` rows per source however long the timeline is, where an OR
+        over the sources sorts all of them. Raises ValueError for a bad cursor.
+
+        Fanned-out history is bounded: a follow backfills TIMELINE_BACKFILL
+        posts and `flask timeline trim` keeps TIMELINE_MAX_ROWS rows per
+        reader, so paging back past those ends the feed; older posts are
+        still on each author's profile.
+        """
+        from app.pagination import keyset_bound
+
+        celebrities = db.session.scalars(
+            sa.select(followers.c.followed_id)
+            .join(User, User.id == followers.c.followed_id)
+            .where(followers.c.follower_id == self.id)
+            .where(User.num_followers >= current_app.config['TIMELINE_CELEBRITY_THRESHOLD'])
+        ).all()
+        sources = [(sa.select(timeline.c.timestamp, timeline.c.post_id).where(timeline.c.user_id == self.id),
+                    (timeline.c.timestamp, timeline.c.post_id))]
+        sources += [(sa.select(Post.timestamp, Post.id).where(Post.user_id == author), (Post.timestamp, Post.id))
+                    for author in [self.id, *celebrities]]
+        branches = []
+        for source, key in sources:
+            condition, order = keyset_bound(key, before, after)
+            if condition is not None:
+                source = source.where(condition)
+            if limit is not None:
+                source = sa.select(source.order_by(*order).limit(limit).subquery())
+            branches.append(source)
+        # UNION, not UNION ALL: posts fanned out before their author became a celebrity come twice
+        feed = sa.union(*branches).subquery('feed')
         return (
             sa.select(Post)
-            .join(Post.author.of_type(Author))
-            .join(Author.followers.of_type(Follower), isouter=True)
-            .where(sa.or_(
-                Follower.id == self.id,
-                Author.id == self.id,
-            ))
-            .group_by(Post)
+            .join(feed, feed.c.post_id == Post.id)
+            .order_by(feed.c.timestamp.desc(), feed.c.post_id.desc())
+        )
+
+    def backfill_timeline(self, user):
+        if user.is_celebrity():
+            return
+        recent = (
+            sa.select(sa.literal(self.id), Post.timestamp, Post.id)
+            .where(Post.user_id == user.id)
+            .order_by(Post.timestamp.desc())
+            .limit(current_app.config['TIMELINE_BACKFILL'])
+        )
+        db.session.execute(timeline.insert().from_select(['user_id', 'timestamp', 'post_id'], recent))
+
+    def fan_out_recent(self):
+        # a former celebrity: what they posted as one was never fanned out, and they are
+        # no longer pulled on read, so push their recent posts to the followers missing them
+        recent = (
+            sa.select(Post.timestamp, Post.id)
+            .where(Post.user_id == self.id)
             .order_by(Post.timestamp.desc())
+            .limit(current_app.config['TIMELINE_BACKFILL'])
+            .subquery()
         )
+        missing = (
+            sa.select(followers.c.follower_id, recent.c.timestamp, recent.c.id)
+            .join(recent, sa.true())    # every follower times every recent post
+            .where(followers.c.followed_id == self.id)
+            .where(~sa.exists().where(timeline.c.user_id == followers.c.follower_id,
+                                      timeline.c.timestamp == recent.c.timestamp,
+                                      timeline.c.post_id == recent.c.id))
+        )
+        db.session.execute(timeline.insert().from_select(['user_id', 'timestamp', 'post_id'], missing))
+
+    def trim_timeline(self):
+        # keep the TIMELINE_MAX_ROWS newest rows: one bounded walk down the primary key finds
+        # the oldest row to keep, then a range delete drops everything behind it
+        oldest_kept = db.session.execute(
+            sa.select(timeline.c.timestamp, timeline.c.post_id)
+            .where(timeline.c.user_id == self.id)
+            .order_by(timeline.c.timestamp.desc(), timeline.c.post_id.desc())
+            .offset(current_app.config['TIMELINE_MAX_ROWS'] - 1)
+            .limit(1)).first()
+        if oldest_kept is None:
+            return 0
+        timestamp, post_id = oldest_kept
+        return db.session.execute(timeline.delete().where(
+            timeline.c.user_id == self.id,
+            sa.or_(timeline.c.timestamp < timestamp,
+                   sa.and_(timeline.c.timestamp == timestamp, timeline.c.post_id < post_id)))).rowcount
+
+    def prune_timeline(self, user):
+        db.session.execute(timeline.delete().where(
+            timeline.c.user_id == self.id,
+            timeline.c.post_id.in_(sa.select(Post.id).where(Post.user_id == user.id))
+        ))
+
+    def rebuild_timeline(self):
+        db.session.execute(timeline.delete().where(timeline.c.user_id == self.id))
+        for user in db.session.scalars(self.following.select()):
+            self.backfill_timeline(user)
     
     def get_reset_password_token(self, expires_in=600):
         return jwt.encode(
@@ -104,15 +252,36 @@ class User(UserMixin, db.Model):
 
 @login.user_loader
 def load_user(id):
-    return db.session.get(User, int(id))
+    return user_cache.get(int(id))
+
+def get_user_by_username(username):
+    # request-scoped cache: the identity map only dedups lookups by primary key
+    cache = g.setdefault('users_by_username', {})
+    if username not in cache:
+        cache[username] = db.session.scalar(sa.select(User).where(User.username == username))
+    return cache[username]
 
 class Post(db.Model):
     id: saorm.Mapped[int] = saorm.mapped_column(primary_key=True)
     body: saorm.Mapped[str] = saorm.mapped_column(sa.String(140))
     timestamp: saorm.Mapped[datetime] = saorm.mapped_column(index=True, default=lambda: datetime.now(timezone.utc))
-    user_id: saorm.Mapped[int] = saorm.mapped_column(sa.ForeignKey(User.id), index=True)
+    user_id: saorm.Mapped[int] = saorm.mapped_column(sa.ForeignKey(User.id))
 
     author: saorm.Mapped[User] = saorm.relationship(back_populates='posts')
 
+    # per-author feeds newest first (scanned backwards), also serves every plain user_id lookup
+    __table_args__ = (sa.Index('ix_post_user_id_timestamp', 'user_id', 'timestamp', 'id'),)
+
     def __repr__(self):
-        return '<Post {}>'.format(self.body)
\ No newline at end of file
+        return '<Post {}>'.format(self.body)
+
+    def fan_out(self):
+        # push the post into every follower's timeline; must run after a flush so id is set
+        if self.author.is_celebrity():
+            return
+        readers = (
+            sa.select(followers.c.follower_id, sa.literal(self.timestamp, sa.DateTime), sa.literal(self.id))
+            .where(followers.c.followed_id == self.user_id)
+        )
+        db.session.execute(timeline.insert().from_select(['user_id', 'timestamp', 'post_id'], readers))
+
@@ -0,0 +1,76 @@
+import base64
+import binascii
+from datetime import datetime
+import sqlalchemy as sa
+from app import db
+from app.models import Post
+
+
+def encode_cursor(timestamp, id):
+    raw = f'{timestamp.isoformat()}|{id}'.encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token):
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)).decode('utf-8')
+        timestamp, id = raw.split('|')
+        return datetime.fromisoformat(timestamp), int(id)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise ValueError(f'Invalid cursor {token!r}')
+
+
+class KeysetPage:
+    def __init__(self, items, before=None, after=None):
+        self.items = items
+        self.before = before    # cursor for older posts, None on the last page
+        self.after = after      # cursor for newer posts, None on the first page
+
+
+def keyset_bound(key, before=None, after=None):
+    """The filter (None on the first page) and ORDER BY that select one keyset page on `key`.
+
+    Queries that merge several sources apply it to each of them, see
+    User.following_posts().
+    """
+    timestamp_col, id_col = key
+    if after is not None:
+        timestamp, id = decode_cursor(after)
+        return (sa.or_(timestamp_col > timestamp, sa.and_(timestamp_col == timestamp, id_col > id)),
+                (timestamp_col.asc(), id_col.asc()))
+    condition = None
+    if before is not None:
+        timestamp, id = decode_cursor(before)
+        condition = sa.or_(timestamp_col < timestamp, sa.and_(timestamp_col == timestamp, id_col < id))
+    return condition, (timestamp_col.desc(), id_col.desc())
+
+
+def keyset_paginate(query, per_page, before=None, after=None, key=(Post.timestamp, Post.id)):
+    """Page through a posts query on (Post.timestamp, Post.id), newest first.
+
+    Unlike db.paginate there is no OFFSET and no COUNT(*); posts inserted while
+    a reader pages backwards don't shift the pages they have not seen yet.
+    `key` swaps in other columns holding the same values, e.g. a denormalized
+    copy whose index already has the query's order.
+    """
+    condition, order = keyset_bound(key, before, after)
+    if condition is not None:
+        query = query.where(condition)
+    rows = db.session.execute(query.order_by(None).order_by(*order).limit(per_page + 1)).all()
+    if after is not None:
+        has_newer = len(rows) > per_page
+        rows = rows[:per_page][::-1]
+        has_older = True
+    else:
+        has_older = len(rows) > per_page
+        rows = rows[:per_page]
+        has_newer = before is not None
+    items = [row[0] if len(row) == 1 else row for row in rows]
+    if not items:
+        return KeysetPage(items)
+    first, last = items[0], items[-1]
+    return KeysetPage(
+        items,
+        before=encode_cursor(last.timestamp, last.id) if has_older else None,
+        after=encode_cursor(first.timestamp, first.id) if has_newer else None,
+    )
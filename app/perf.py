@@ -0,0 +1,160 @@
+import json
+import random
+import threading
+import time
+from flask import g, has_request_context, request, jsonify, abort, before_render_template, template_rendered
+from flask_login import current_user
+import sqlalchemy as sa
+
+
+class RequestTiming:
+    __slots__ = ('start', 'sql_count', 'sql_ms', 'slowest_ms', 'slowest_sql', 'render_ms',
+                 'render_depth', 'render_start', 'phases')
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.sql_count = 0
+        self.sql_ms = 0.0
+        self.slowest_ms = 0.0
+        self.slowest_sql = None
+        self.render_ms = 0.0
+        self.render_depth = 0
+        self.render_start = 0.0
+        self.phases = {}    # name -> ms, for work timed by other components, see record()
+
+
+class PerfStats:
+    """Per-request SQL and template timing, plus the /_stats endpoint.
+
+    With PERF_ENABLED off no hooks are installed at all. When on, every
+    response gets a Server-Timing header, PERF_LOG_SAMPLE_RATE of requests
+    are logged as JSON, and per-endpoint totals are kept in process.
+    /_stats also reports every metric source added with register().
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self._lock = threading.Lock()
+        self.endpoints = {}
+        self.sources = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        from app.database import all_engines
+
+        app.extensions['perf'] = self
+        self.app = app
+        with self._lock:
+            self.endpoints = {}
+        self.sources = {}
+        app.add_url_rule('/_stats', 'perf_stats', self.stats_view)
+        if not app.config['PERF_ENABLED']:
+            return
+        app.before_request(self._start_request)
+        app.after_request(self._finish_request)
+        before_render_template.connect(self._before_render, app)
+        template_rendered.connect(self._after_render, app)
+        for engine in all_engines(app):
+            sa.event.listen(engine, 'before_cursor_execute', self._before_cursor_execute)
+            sa.event.listen(engine, 'after_cursor_execute', self._after_cursor_execute)
+
+    def register(self, name, stats):
+        """Expose a zero-argument callable returning a dict under `name` in /_stats."""
+        self.sources[name] = stats
+
+    def record(self, phase, ms):
+        """Add `ms` spent in `phase` to the current request's Server-Timing."""
+        timing = g.get('perf') if has_request_context() else None
+        if timing is not None:
+            timing.phases[phase] = timing.phases.get(phase, 0.0) + ms
+
+    def snapshot(self):
+        with self._lock:
+            endpoints = {
+                name: {
+                    'requests': e['requests'],
+                    'mean_ms': e['total_ms'] / e['requests'],
+                    'max_ms': e['max_ms'],
+                    'mean_sql_count': e['sql_count'] / e['requests'],
+                    'mean_sql_ms': e['sql_ms'] / e['requests'],
+                    'mean_render_ms': e['render_ms'] / e['requests'],
+                }
+                for name, e in self.endpoints.items()}
+        return {'endpoints': endpoints, 'metrics': {name: stats() for name, stats in self.sources.items()}}
+
+    def stats_view(self):
+        token = self.app.config['PERF_STATS_TOKEN']
+        if token and request.headers.get('Authorization') == f'Bearer {token}':
+            return jsonify(self.snapshot())
+        if current_user.is_authenticated and current_user.email in self.app.config['ADMINS']:
+            return jsonify(self.snapshot())
+        abort(404)
+
+    def _start_request(self):
+        g.perf = RequestTiming()
+
+    def _finish_request(self, response):
+        timing = g.pop('perf', None)
+        if timing is None:
+            return response
+        total_ms = (time.perf_counter() - timing.start) * 1000
+        response.headers['Server-Timing'] = (
+            f'sql;dur={timing.sql_ms:.1f};desc="{timing.sql_count} queries", '
+            f'render;dur={timing.render_ms:.1f}, '
+            + ''.join(f'{phase};dur={ms:.1f}, ' for phase, ms in timing.phases.items())
+            + f'total;dur={total_ms:.1f}')
+        endpoint = request.endpoint or 'unknown'
+        with self._lock:
+            e = self.endpoints.setdefault(endpoint, {
+                'requests': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'sql_count': 0, 'sql_ms': 0.0, 'render_ms': 0.0})
+            e['requests'] += 1
+            e['total_ms'] += total_ms
+            e['max_ms'] = max(e['max_ms'], total_ms)
+            e['sql_count'] += timing.sql_count
+            e['sql_ms'] += timing.sql_ms
+            e['render_ms'] += timing.render_ms
+        if random.random() < self.app.config['PERF_LOG_SAMPLE_RATE']:
+            self.app.logger.info('perf %s', json.dumps({
+                'endpoint': endpoint,
+                'method': request.method,
+                'status': response.status_code,
+                'total_ms': round(total_ms, 2),
+                'sql_count': timing.sql_count,
+                'sql_ms': round(timing.sql_ms, 2),
+                'slowest_sql_ms': round(timing.slowest_ms, 2),
+                'slowest_sql': timing.slowest_sql,
+                'render_ms': round(timing.render_ms, 2),
+                **{f'{phase}_ms': round(ms, 2) for phase, ms in timing.phases.items()},
+            }))
+        return response
+
+    def _before_render(self, sender, template, context, **extra):
+        timing = g.get('perf')
+        if timing is not None:
+            if timing.render_depth == 0:
+                timing.render_start = time.perf_counter()
+            timing.render_depth += 1
+
+    def _after_render(self, sender, template, context, **extra):
+        timing = g.get('perf')
+        if timing is not None and timing.render_depth:
+            timing.render_depth -= 1
+            if timing.render_depth == 0:    # nested renders (post rows) count once
+                timing.render_ms += (time.perf_counter() - timing.render_start) * 1000
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if has_request_context() and 'perf' in g:
+            conn.info.setdefault('perf_start', []).append(time.perf_counter())
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        starts = conn.info.get('perf_start')
+        if not starts or not has_request_context() or 'perf' not in g:
+            return
+        elapsed = (time.perf_counter() - starts.pop()) * 1000
+        timing = g.perf
+        timing.sql_count += 1
+        timing.sql_ms += elapsed
+        if elapsed > timing.slowest_ms:
+            timing.slowest_ms = elapsed
+            timing.slowest_sql = statement[:200]
@@ -1,23 +1,34 @@
-from flask import Blueprint, render_template, flash, redirect, url_for, request, abort, current_app
+from flask import Blueprint, render_template, stream_template, get_flashed_messages, flash, redirect, url_for, request, abort, current_app, g, session
+from flask_wtf.csrf import generate_csrf
 import sqlalchemy as sa
-from app import db
+import sqlalchemy.orm as saorm
+from app import db, last_seen, fragments, search, user_cache, graph, stream_hub, tags
 from app.email import send_password_reset_email
-from app.forms import LoginForm, RegistrationForm, EditProfileForm, EmptyForm, PostForm, ResetPasswordRequestForm, ResetPasswordForm
-from app.models import User, Post
+from app.forms import LoginForm, RegistrationForm, EditProfileForm, EmptyForm, PostForm, ResetPasswordRequestForm, ResetPasswordForm, SearchForm
+from app.models import User, Post, get_user_by_username, post_tag
+from app.pagination import keyset_paginate
+from app.tags import TAG_RE
 from urllib.parse import urlsplit
+from hashlib import md5
+from markupsafe import Markup, escape
+from time import time
+from werkzeug.http import is_resource_modified
+from werkzeug.exceptions import ServiceUnavailable
 from flask_login import current_user, login_user, logout_user, login_required
-from datetime import datetime, timezone
 from sqlalchemy.exc import IntegrityError
 
 bp = Blueprint('routes', __name__)
 
 def change_username(user, new_username):
     user.username = new_username
+    g.pop('users_by_username', None)
     try:
+        search.add_user(user)
         db.session.commit()
     except IntegrityError:
         db.session.rollback()
         abort(500)
+    fragments.invalidate_user(user.id)
 
 
 def change_bio(user, new_bio):
@@ -29,11 +40,127 @@ def change_bio(user, new_bio):
         abort(500)
 
 
+class PostWindow:
+    """One page of a posts query as plain rows, and the url args of the pages around it."""
+
+    def __init__(self, rows, older=None, newer=None):
+        self.rows = rows
+        self.older = older
+        self.newer = newer
+
+
+def paginate_posts(window, endpoint, **values):
+    # the posts of a page post_window already found, by primary key instead of running the feed query again
+    ids = [row.id for row in window.rows]
+    by_id = {post.id: post for post in db.session.scalars(
+        sa.select(Post).where(Post.id.in_(ids)).options(saorm.selectinload(Post.author)))} if ids else {}
+    posts = [by_id[id] for id in ids if id in by_id]
+    next_url = url_for(endpoint, **window.older, **values) if window.older else None
+    prev_url = url_for(endpoint, **window.newer, **values) if window.newer else None
+    return posts, next_url, prev_url
+
+
+def home_feed(user):
+    # the page's cursor and size go into each source of the feed, see User.following_posts
+    if 'page' in request.args:
+        return user.following_posts()
+    try:
+        return user.following_posts(request.args.get('before'), request.args.get('after'),
+                                    current_app.config['POSTS_PER_PAGE'] + 1)
+    except ValueError:
+        abort(400)
+
+
+def post_window(query, key=(Post.timestamp, Post.id)):
+    # the posts a page of `query` shows as plain rows, enough to tell whether the page changed
+    # and to load it; the body is in there because posts can be edited
+    query = (query.with_only_columns(Post.id, Post.timestamp, Post.body, User.username, User.email)
+             .join(User, User.id == Post.user_id))
+    per_page = current_app.config['POSTS_PER_PAGE']
+    if 'page' in request.args:  # old ?page= links keep working through offset pagination
+        page = max(request.args.get('page', 1, type=int), 1)
+        rows = db.session.execute(query.limit(per_page + 1).offset((page - 1) * per_page)).all()
+        return PostWindow(rows[:per_page], older={'page': page + 1} if len(rows) > per_page else None,
+                          newer={'page': page - 1} if page > 1 else None)
+    try:
+        page = keyset_paginate(query, per_page, before=request.args.get('before'),
+                               after=request.args.get('after'), key=key)
+    except ValueError:
+        abort(400)
+    return PostWindow(page.items, older={'before': page.before} if page.before else None,
+                      newer={'after': page.after} if page.after else None)
+
+
+def buffered(chunks, size):
+    # join the template's many small strings into writes of about `size` characters
+    buffer, length = [], 0
+    for chunk in chunks:
+        buffer.append(chunk)
+        length += len(chunk)
+        if length >= size:
+            yield ''.join(buffer)
+            buffer, length = [], 0
+    if buffer:
+        yield ''.join(buffer)
+
+
+def render_page(template, **context):
+    # with TEMPLATE_STREAMING the header and first posts go out while later rows still render
+    if not current_app.config['TEMPLATE_STREAMING']:
+        return render_template(template, **context)
+    # headers, and with them the session cookie, are sent before the body renders,
+    # so whatever the template would store in the session has to happen now
+    get_flashed_messages()
+    if current_app.config['WTF_CSRF_ENABLED']:
+        generate_csrf()
+    return current_app.response_class(
+        buffered(stream_template(template, **context), current_app.config['TEMPLATE_STREAM_BUFFER']),
+        mimetype='text/html')
+
+
+def not_modified(window, *validators):
+    # 304 when the client's copy is current, so a hit never loads posts or renders templates
+    if session.get('_flashes'):
+        return None
+    # pages embed CSRF tokens that expire, so validators roll over every half hour
+    validators = (current_user.id, current_user.username, int(time() // 1800),
+                  [tuple(row) for row in window.rows], validators)
+    etag = md5(repr(validators).encode('utf-8')).hexdigest()
+    # no Last-Modified: the newest post says nothing about profiles, follow state or the CSRF
+    # bucket, so an If-Modified-Since alone must never produce a 304
+    g.etag = etag
+    if is_resource_modified(request.environ, etag=etag):
+        return None
+    return current_app.response_class(status=304)
+
+
+@bp.after_request
+def set_validators(response):
+    if 'etag' in g and response.status_code in (200, 304):
+        response.set_etag(g.etag)
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        response.vary.add('Cookie')
+    return response
+
+
+@bp.app_template_filter('hashtags')
+def link_hashtags(text):
+    # wrap every #tag in a link to its feed, escaping the text in between
+    html, last = Markup(), 0
+    for match in TAG_RE.finditer(text or ''):
+        html += escape(text[last:match.start()])
+        html += Markup('<a href="{}">#{}</a>').format(url_for('routes.tag', name=match.group(1).lower()),
+                                                     match.group(1))
+        last = match.end()
+    return html + escape((text or '')[last:])
+
+
 @bp.before_request # means before view func
 def before_request():
     if current_user.is_authenticated:
-        current_user.last_seen = datetime.now(timezone.utc)
-        db.session.commit()
+        last_seen.touch(current_user)
+        g.search_form = SearchForm()
 
 @bp.route('/register', methods=['GET', 'POST'])
 def register():
@@ -44,6 +171,8 @@ def register():
         user = User(username=form.username.data, email=form.email.data)
         user.set_password(form.password.data)
         db.session.add(user)
+        db.session.flush()
+        search.add_user(user)
         db.session.commit()
         flash('Congratulations, you are now a registered user!')
         return redirect(url_for('routes.login'))
@@ -88,6 +217,7 @@ def login():
             flash('FUCK OFF Неверный email или пароль')
             return redirect(url_for('routes.login'))
         login_user(user, remember=form.remember_me.data)
+        db.session.commit()     # keeps a hash upgraded by check_password
         next_page = request.args.get('next')
         if not next_page or urlsplit(next_page).netloc != '':
             next_page = url_for('routes.index')
@@ -96,25 +226,35 @@ def login():
 
 @bp.route('/logout')
 def logout():
+    if current_user.is_authenticated:
+        user_cache.invalidate(current_user.id)
     logout_user()
     return redirect(url_for('routes.index'))
 
 @bp.route('/user/<username>')
 @login_required
 def user(username):
-    user = db.first_or_404(sa.select(User).where(User.username == username))
-    page = request.args.get('page', 1, type=int)
+    user = get_user_by_username(username)
+    if user is None:
+        abort(404)
     query = user.posts.select().order_by(Post.timestamp.desc())
-    posts = db.paginate(query, page=page,
-                        per_page=current_app.config['POSTS_PER_PAGE'],
-                        error_out=False)
-    next_url = url_for('routes.user', username=user.username, page=posts.next_num) \
-        if posts.has_next else None
-    prev_url = url_for('routes.user', username=user.username, page=posts.prev_num) \
-        if posts.has_prev else None 
+    following = user != current_user and current_user.is_following(user)
+    window = post_window(query)
+    response = not_modified(window, user.username, user.email, user.about_me,
+                            user.last_seen, user.num_followers, user.num_following, following)
+    if response:
+        return response
+    posts, next_url, prev_url = paginate_posts(window, 'routes.user', username=user.username)
+    # a few minutes old at most, and not worth a full render when only they changed
+    suggested = graph.suggestions(current_user.id, current_app.config['SUGGESTIONS_LIMIT'])
+    suggestions = []
+    if suggested:
+        by_id = {u.id: u for u in db.session.scalars(
+            sa.select(User).where(User.id.in_([id for id, _ in suggested])))}
+        suggestions = [(by_id[id], mutual) for id, mutual in suggested if id in by_id]
     form = EmptyForm()
-    return render_template('user.html', user=user, posts=posts, 
-                           next_url=next_url, prev_url=prev_url, form=form)
+    return render_page('user.html', user=user, posts=posts, following=following,
+                       suggestions=suggestions, next_url=next_url, prev_url=prev_url, form=form)
 
 @bp.route('/user/edit_profile', methods=['GET', 'POST'])
 @login_required
@@ -135,7 +275,7 @@ def edit_profile():
 def follow(username):
     form = EmptyForm()
     if form.validate_on_submit():
-        user = db.session.scalar(sa.select(User).where(User.username == username))
+        user = get_user_by_username(username)
         if user is None:
             flash(f'User {username} not found.')
             return redirect(url_for('routes.index'))
@@ -154,8 +294,7 @@ def follow(username):
 def unfollow(username):
     form = EmptyForm()
     if form.validate_on_submit():
-        user = db.session.scalar(
-            sa.select(User).where(User.username == username))
+        user = get_user_by_username(username)
         if user is None:
             flash(f'User {username} not found.')
             return redirect(url_for('routes.index'))
@@ -172,18 +311,16 @@ def unfollow(username):
 @bp.route('/explore')
 @login_required
 def explore():
-    page = request.args.get('page', 1, type=int)
     query = sa.select(Post).order_by(Post.timestamp.desc())
-    posts = db.paginate(query, page=page, 
-                        per_page=current_app.config['POSTS_PER_PAGE'], 
-                        error_out=False)
-    next_url = url_for('routes.explore', page=posts.next_num) \
-        if posts.has_next else None
-    prev_url = url_for('routes.explore', page=posts.prev_num) \
-        if posts.has_prev else None 
-    return render_template('index.html', title='Explore',
-                            posts=posts.items, 
-                            next_url=next_url, prev_url=prev_url)
+    trending = tags.trending()
+    window = post_window(query)
+    response = not_modified(window, trending)
+    if response:
+        return response
+    posts, next_url, prev_url = paginate_posts(window, 'routes.explore')
+    return render_page('index.html', title='Explore',
+                        posts=posts, trending=trending,
+                        next_url=next_url, prev_url=prev_url)
 
 @bp.route('/', methods=['GET', 'POST'])
 @bp.route('/index', methods=['GET', 'POST'])
@@ -193,18 +330,80 @@ def index():
     if form.validate_on_submit():
         post = Post(body=form.post.data, author=current_user)
         db.session.add(post)
+        current_user.num_posts = User.num_posts + 1
+        db.session.flush()
+        post.fan_out()
+        search.add_post(post)
+        tags.add_post(post)
         db.session.commit()
+        stream_hub.publish(post)
         flash('Your post is now live!')
         return redirect(url_for('routes.index'))
-    page = request.args.get('page', 1, type=int)
-    posts = db.paginate(current_user.following_posts(), page=page, 
-                        per_page=current_app.config['POSTS_PER_PAGE'], 
-                        error_out=False)
-    next_url = url_for('routes.index', page=posts.next_num) \
-        if posts.has_next else None
-    prev_url = url_for('routes.index', page=posts.prev_num) \
-        if posts.has_prev else None
-    return render_template('index.html', title = 'Home', 
-                            form=form, posts=posts.items,
-                            next_url=next_url, prev_url=prev_url)
+    window = post_window(home_feed(current_user))
+    trending = tags.trending()
+    if request.method == 'GET':
+        response = not_modified(window, trending)
+        if response:
+            return response
+    posts, next_url, prev_url = paginate_posts(window, 'routes.index')
+    return render_page('index.html', title = 'Home', 
+                        form=form, posts=posts, trending=trending,
+                        next_url=next_url, prev_url=prev_url)
+
 
+@bp.route('/tag/<name>')
+@login_required
+def tag(name):
+    name = name.lower()
+    # paging on post_tag's copy of the sort key walks its (tag, timestamp, post_id)
+    # primary key in order, a popular tag never sorts all of its posts
+    key = (post_tag.c.timestamp, post_tag.c.post_id)
+    query = (sa.select(Post)
+             .join(post_tag, post_tag.c.post_id == Post.id)
+             .where(post_tag.c.tag == name)
+             .order_by(post_tag.c.timestamp.desc(), post_tag.c.post_id.desc()))
+    window = post_window(query, key)
+    response = not_modified(window)
+    if response:
+        return response
+    posts, next_url, prev_url = paginate_posts(window, 'routes.tag', name=name)
+    return render_page('index.html', title=f'#{name}', heading=f'#{name}',
+                        posts=posts,
+                        next_url=next_url, prev_url=prev_url)
+
+
+@bp.route('/stream')
+@login_required
+def stream():
+    subscription = stream_hub.subscribe(current_user.id)
+    if subscription is None:
+        raise ServiceUnavailable(retry_after=current_app.config['ADMISSION_RETRY_AFTER'])
+    response = current_app.response_class(stream_hub.events(subscription), mimetype='text/event-stream',
+                                          headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # frees the slot even when the client goes away before the first event
+    response.call_on_close(lambda: stream_hub.unsubscribe(subscription))
+    return response
+
+
+@bp.route('/search')
+@login_required
+def search_view():
+    if not g.search_form.validate():
+        return redirect(url_for('routes.explore'))
+    q = g.search_form.q.data
+    page = max(request.args.get('page', 1, type=int), 1)
+    ids, has_next = search.posts(q, page, current_app.config['POSTS_PER_PAGE'])
+    found = db.session.scalars(
+        sa.select(Post).where(Post.id.in_(ids)).options(saorm.selectinload(Post.author))).all()
+    rank = {id: i for i, id in enumerate(ids)}
+    posts = sorted(found, key=lambda post: rank[post.id])
+    users = []
+    if page == 1:
+        user_ids = search.users(q, current_app.config['SEARCH_USERS_LIMIT'])
+        found = db.session.scalars(sa.select(User).where(User.id.in_(user_ids))).all()
+        rank = {id: i for i, id in enumerate(user_ids)}
+        users = sorted(found, key=lambda user: rank[user.id])
+    next_url = url_for('routes.search_view', q=q, page=page + 1) if has_next else None
+    prev_url = url_for('routes.search_view', q=q, page=page - 1) if page > 1 else None
+    return render_template('search.html', title='Search', posts=posts, users=users,
+                           next_url=next_url, prev_url=prev_url)
@@ -0,0 +1,269 @@
+import math
+import re
+import threading
+import weakref
+from collections import Counter
+import sqlalchemy as sa
+import sqlalchemy.orm as saorm
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(text):
+    return [token.lower() for token in TOKEN_RE.findall(text or '')]
+
+
+class FTS5Index:
+    """Inverted index kept by SQLite FTS5 in post_fts and user_fts.
+
+    Rows are written through the caller's session, so index updates commit
+    or roll back together with the post or user they belong to.
+    """
+
+    TABLES = {
+        'post_fts': 'CREATE VIRTUAL TABLE IF NOT EXISTS post_fts USING fts5(body)',
+        'user_fts': 'CREATE VIRTUAL TABLE IF NOT EXISTS user_fts USING fts5(username)',
+    }
+
+    def __init__(self, db):
+        self.db = db
+        self._ready = weakref.WeakSet()    # engines known to have the tables
+
+    def ensure_tables(self):
+        engine = self.db.engine
+        if engine in self._ready:
+            return
+        for ddl in self.TABLES.values():
+            self.db.session.execute(sa.text(ddl))
+        self._ready.add(engine)
+
+    def add_post(self, id, body):
+        self.ensure_tables()
+        self.db.session.execute(sa.text('INSERT INTO post_fts(rowid, body) VALUES (:id, :body)'),
+                                {'id': id, 'body': body})
+
+    def add_user(self, id, username):
+        self.ensure_tables()
+        self.db.session.execute(sa.text('DELETE FROM user_fts WHERE rowid = :id'), {'id': id})
+        self.db.session.execute(sa.text('INSERT INTO user_fts(rowid, username) VALUES (:id, :username)'),
+                                {'id': id, 'username': username})
+
+    def search_posts(self, terms, limit, offset=0):
+        return self._match('post_fts', self._match_query(terms), limit, offset)
+
+    def search_users(self, terms, limit, offset=0):
+        # usernames match as you type, so the last term is a prefix
+        return self._match('user_fts', self._match_query(terms) + '*', limit, offset)
+
+    def reindex(self, posts, users):
+        self.ensure_tables()
+        self.db.session.execute(sa.text('DELETE FROM post_fts'))
+        self.db.session.execute(sa.text('DELETE FROM user_fts'))
+        for chunk in posts:
+            self.db.session.execute(sa.text('INSERT INTO post_fts(rowid, body) VALUES (:id, :body)'),
+                                    [{'id': id, 'body': body} for id, body in chunk])
+        for chunk in users:
+            self.db.session.execute(sa.text('INSERT INTO user_fts(rowid, username) VALUES (:id, :username)'),
+                                    [{'id': id, 'username': username} for id, username in chunk])
+
+    def _match(self, table, match, limit, offset):
+        self.ensure_tables()
+        rows = self.db.session.execute(
+            sa.text(f'SELECT rowid FROM {table} WHERE {table} MATCH :match ORDER BY rank LIMIT :limit OFFSET :offset'),
+            {'match': match, 'limit': limit, 'offset': offset})
+        return [row[0] for row in rows]
+
+    @staticmethod
+    def _match_query(terms):
+        # quote every term so user input can't inject FTS5 query syntax
+        return ' '.join('"{}"'.format(term.replace('"', '""')) for term in terms)
+
+
+class MemoryIndex:
+    """Pure-Python inverted index with BM25 ranking, for databases without FTS5.
+
+    Each process builds it from the database on first use. Its own writes
+    are applied once their session commits, and every search first reads
+    the posts and users other processes added since, by id. Username
+    changes made by other processes show up after `flask search reindex`.
+    """
+
+    K1 = 1.2
+    B = 0.75
+
+    def __init__(self, db):
+        self.db = db
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()     # one first load per process, the others wait for it
+        self._loaded = False
+        self._docs = {'post': {}, 'user': {}}      # kind -> doc id -> length
+        self._postings = {'post': {}, 'user': {}}  # kind -> term -> {doc id: term frequency}
+        self._last = {'post': 0, 'user': 0}        # kind -> highest id indexed
+
+    def add_post(self, id, body):
+        self._record('post', id, body)
+
+    def add_user(self, id, username):
+        self._record('user', id, username)
+
+    def apply(self, kind, id, text):
+        if self._loaded:    # otherwise the first load reads it from the database
+            self._add(kind, id, text)
+
+    def search_posts(self, terms, limit, offset=0):
+        self._catch_up('post')
+        return self._rank('post', terms, limit, offset)
+
+    def search_users(self, terms, limit, offset=0):
+        self._catch_up('user')
+        return self._rank('user', terms, limit, offset, prefix=True)
+
+    def reindex(self, posts, users):
+        # build aside and swap, searches keep using the old index until it's complete
+        docs = {'post': {}, 'user': {}}
+        postings = {'post': {}, 'user': {}}
+        for kind, chunks in (('post', posts), ('user', users)):
+            for chunk in chunks:
+                for id, text in chunk:
+                    self._index(docs[kind], postings[kind], id, text)
+        with self._lock:
+            self._docs, self._postings = docs, postings
+            self._last = {kind: max(docs[kind], default=0) for kind in docs}
+            self._loaded = True
+
+    def _ensure_loaded(self):
+        if self._loaded:
+            return
+        with self._load_lock:
+            if not self._loaded:
+                from app.models import Post, User
+                self.reindex(iter_chunks(sa.select(Post.id, Post.body)),
+                             iter_chunks(sa.select(User.id, User.username)))
+
+    def _catch_up(self, kind):
+        from app.models import Post, User
+
+        self._ensure_loaded()
+        model, column = (Post, Post.body) if kind == 'post' else (User, User.username)
+        for chunk in iter_chunks(sa.select(model.id, column).where(model.id > self._last[kind])):
+            for id, text in chunk:
+                self._add(kind, id, text)
+
+    def _record(self, kind, id, text):
+        # applied once the session commits, see Search._after_commit
+        self.db.session.info.setdefault('search_docs', []).append((kind, id, text))
+
+    def _add(self, kind, id, text):
+        with self._lock:
+            self._remove(kind, id)
+            self._index(self._docs[kind], self._postings[kind], id, text)
+            self._last[kind] = max(self._last[kind], id)
+
+    @staticmethod
+    def _index(docs, postings, id, text):
+        terms = Counter(tokenize(text))
+        docs[id] = sum(terms.values())
+        for term, tf in terms.items():
+            postings.setdefault(term, {})[id] = tf
+
+    def _remove(self, kind, id):
+        if self._docs[kind].pop(id, None) is None:
+            return
+        for term in list(self._postings[kind]):
+            docs = self._postings[kind][term]
+            if docs.pop(id, None) is not None and not docs:
+                del self._postings[kind][term]
+
+    def _rank(self, kind, terms, limit, offset, prefix=False):
+        with self._lock:
+            docs, postings = self._docs[kind], self._postings[kind]
+            if not docs or not terms:
+                return []
+            avg_len = sum(docs.values()) / len(docs)
+            scores = None
+            for i, term in enumerate(terms):
+                if prefix and i == len(terms) - 1:
+                    matches = {}
+                    for candidate, candidate_docs in postings.items():
+                        if candidate.startswith(term):
+                            for id, tf in candidate_docs.items():
+                                matches[id] = max(matches.get(id, 0), tf)
+                else:
+                    matches = postings.get(term, {})
+                idf = math.log(1 + (len(docs) - len(matches) + 0.5) / (len(matches) + 0.5))
+                term_scores = {
+                    id: idf * tf * (self.K1 + 1) / (tf + self.K1 * (1 - self.B + self.B * docs[id] / avg_len))
+                    for id, tf in matches.items()}
+                if scores is None:
+                    scores = term_scores
+                else:   # every term has to match
+                    scores = {id: score + term_scores[id] for id, score in scores.items() if id in term_scores}
+                if not scores:
+                    return []
+        ranked = sorted(scores, key=lambda id: (-scores[id], -id))
+        return ranked[offset:offset + limit]
+
+
+def iter_chunks(query, chunk_size=1000):
+    from app import db
+
+    for partition in db.session.execute(query.execution_options(yield_per=chunk_size)).partitions():
+        yield [tuple(row) for row in partition]
+
+
+class Search:
+    """Full-text search over Post.body and User.username.
+
+    SEARCH_BACKEND picks the index: 'fts5', 'memory', or 'auto' to use FTS5
+    whenever the database is SQLite.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.index = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        from app import db
+
+        app.extensions['search'] = self
+        self.app = app
+        backend = app.config['SEARCH_BACKEND']
+        if backend == 'auto':
+            backend = 'fts5' if app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite') else 'memory'
+        self.index = FTS5Index(db) if backend == 'fts5' else MemoryIndex(db)
+        if not sa.event.contains(saorm.Session, 'after_commit', self._after_commit):
+            sa.event.listen(saorm.Session, 'after_commit', self._after_commit)
+            sa.event.listen(saorm.Session, 'after_soft_rollback', self._after_rollback)
+
+    def add_post(self, post):
+        self.index.add_post(post.id, post.body)
+
+    def add_user(self, user):
+        self.index.add_user(user.id, user.username)
+
+    def posts(self, text, page, per_page):
+        """Ranked post ids for one page of results, and whether a next page exists."""
+        terms = tokenize(text)
+        if not terms:
+            return [], False
+        ids = self.index.search_posts(terms, per_page + 1, (page - 1) * per_page)
+        return ids[:per_page], len(ids) > per_page
+
+    def users(self, text, limit):
+        terms = tokenize(text)
+        return self.index.search_users(terms, limit) if terms else []
+
+    def reindex(self, chunk_size=1000):
+        from app.models import Post, User
+
+        self.index.reindex(iter_chunks(sa.select(Post.id, Post.body).order_by(Post.id), chunk_size),
+                           iter_chunks(sa.select(User.id, User.username).order_by(User.id), chunk_size))
+
+    def _after_commit(self, session):
+        for doc in session.info.pop('search_docs', ()):
+            self.index.apply(*doc)
+
+    def _after_rollback(self, session, previous_transaction):
+        session.info.pop('search_docs', None)
@@ -0,0 +1,196 @@
+import json
+import queue
+import threading
+import time
+import sqlalchemy as sa
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+
+class LocalBroker:
+    """In-process stand-in for a cross-process broker.
+
+    Every hub subscribed to the same LocalBroker gets every message,
+    delivered synchronously, which is how tests run several "processes"
+    side by side without a redis server.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._listeners = []
+
+    def subscribe(self, callback):
+        with self._lock:
+            self._listeners.append(callback)
+
+    def publish(self, message):
+        with self._lock:
+            listeners = list(self._listeners)
+        for callback in listeners:
+            callback(message)
+
+
+class RedisBroker:
+    """Fans messages out to every process through a redis pub/sub channel."""
+
+    def __init__(self, url, channel='microblog:stream'):
+        if redis is None:
+            raise RuntimeError('STREAM_REDIS_URL is set but the redis package is not installed')
+        self.client = redis.Redis.from_url(url)
+        self.channel = channel
+        self._listeners = []
+        self._thread = None
+
+    def subscribe(self, callback):
+        self._listeners.append(callback)
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='stream-broker', daemon=True)
+            self._thread.start()
+
+    def publish(self, message):
+        self.client.publish(self.channel, json.dumps(message))
+
+    def _run(self):
+        pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(self.channel)
+        for item in pubsub.listen():
+            message = json.loads(item['data'])
+            for callback in self._listeners:
+                callback(message)
+
+
+class Subscription:
+    __slots__ = ('user_id', 'queue', 'dropped')
+
+    def __init__(self, user_id, size):
+        self.user_id = user_id
+        self.queue = queue.Queue(size)
+        self.dropped = False
+
+
+class StreamHub:
+    """Pushes new posts to the followers connected to /stream.
+
+    A post is rendered once and published to the broker; each process's hub
+    hands it to its own subscribers who follow the author. Every connection
+    buffers at most STREAM_QUEUE_SIZE fragments. A consumer that falls
+    further behind is dropped and told to reload rather than buffered
+    without bound. A process holds at most STREAM_MAX_CONNECTIONS
+    connections and a user at most STREAM_MAX_PER_USER of them;
+    subscribe() returns None beyond either.
+    """
+
+    def __init__(self, app=None, broker=None):
+        self.app = None
+        self._broker = broker
+        self.broker = None
+        self._lock = threading.Lock()
+        self._subscriptions = {}    # user id -> set of Subscription
+        self.published = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.rejected = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['stream'] = self
+        self.app = app
+        with self._lock:
+            self._subscriptions = {}
+        self.published = self.delivered = self.dropped = self.rejected = 0
+        if self._broker is not None:
+            self.broker = self._broker
+        elif app.config['STREAM_REDIS_URL']:
+            self.broker = RedisBroker(app.config['STREAM_REDIS_URL'])
+        else:
+            self.broker = LocalBroker()
+        self.broker.subscribe(self.deliver)
+
+    def subscribe(self, user_id):
+        subscription = Subscription(user_id, self.app.config['STREAM_QUEUE_SIZE'])
+        with self._lock:
+            connections = sum(len(subscriptions) for subscriptions in self._subscriptions.values())
+            if (connections >= self.app.config['STREAM_MAX_CONNECTIONS']
+                    or len(self._subscriptions.get(user_id, ())) >= self.app.config['STREAM_MAX_PER_USER']):
+                self.rejected += 1
+                return None
+            self._subscriptions.setdefault(user_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.user_id)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._subscriptions[subscription.user_id]
+
+    def publish(self, post):
+        from app import fragments
+
+        self.published += 1
+        self.broker.publish({'author_id': post.author.id, 'post_id': post.id,
+                             'html': str(fragments.render_post(post))})
+
+    def deliver(self, message):
+        from app import db
+        from app.models import followers
+
+        author_id = message['author_id']
+        with self._lock:
+            connected = {user_id: list(subscriptions) for user_id, subscriptions in self._subscriptions.items()}
+        if not connected:
+            return
+        # followers from SQL, so follows made through other processes count at once
+        readers = {author_id}
+        ids = list(connected)
+        with self.app.app_context():    # brokers call from their own threads
+            for start in range(0, len(ids), 500):
+                readers.update(db.session.scalars(
+                    sa.select(followers.c.follower_id)
+                    .where(followers.c.followed_id == author_id,
+                           followers.c.follower_id.in_(ids[start:start + 500]))))
+        recipients = [subscription for user_id in readers & connected.keys() for subscription in connected[user_id]]
+        for subscription in recipients:
+            try:
+                subscription.queue.put_nowait(message)
+                self.delivered += 1
+            except queue.Full:
+                subscription.dropped = True
+                self.dropped += 1
+                self.unsubscribe(subscription)
+
+    def events(self, subscription):
+        """SSE lines for one connection, until it is dropped or reaches STREAM_MAX_AGE."""
+        heartbeat = self.app.config['STREAM_HEARTBEAT']
+        deadline = time.monotonic() + self.app.config['STREAM_MAX_AGE']
+        try:
+            yield f'retry: {heartbeat * 1000}\n\n'
+            while time.monotonic() < deadline:
+                if subscription.dropped:
+                    yield 'event: reset\ndata: \n\n'
+                    return
+                try:
+                    message = subscription.queue.get(timeout=heartbeat)
+                except queue.Empty:
+                    yield ': heartbeat\n\n'
+                    continue
+                data = ''.join(f'data: {line}\n' for line in message['html'].splitlines())
+                yield f'id: {message["post_id"]}\nevent: post\n{data}\n'
+        finally:
+            self.unsubscribe(subscription)
+
+    def stats(self):
+        with self._lock:
+            connections = sum(len(subscriptions) for subscriptions in self._subscriptions.values())
+        return {
+            'connections': connections,
+            'published': self.published,
+            'delivered': self.delivered,
+            'dropped': self.dropped,
+            'rejected': self.rejected,
+        }
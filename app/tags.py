@@ -0,0 +1,185 @@
+import re
+import threading
+import time
+from collections import Counter
+from datetime import timezone
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
+
+TAG_RE = re.compile(r'(?<!\S)#(\w{1,64})', re.UNICODE)    # only at the start of a word
+UPSERT_DIALECTS = {'sqlite': sqlite, 'postgresql': postgresql}     # INSERT .. ON CONFLICT DO UPDATE
+
+
+def extract_tags(text):
+    """Distinct lowercased hashtags in `text`, in order of appearance."""
+    return list(dict.fromkeys(tag.lower() for tag in TAG_RE.findall(text or '')))
+
+
+class TagIndex:
+    """Hashtags for /tag/<name> feeds and the trending topics panel.
+
+    add_post() writes one post_tag row per tag and bumps tag_count, a
+    counter per tag and TRENDING_BUCKET-second bucket, in the caller's
+    session. Trending sums the last TRENDING_WINDOW buckets, with the
+    oldest one weighted by how much of it is still inside the window, so
+    the ranking slides smoothly instead of jumping at bucket boundaries.
+    Nothing ever rescans posts except backfill().
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self._lock = threading.Lock()
+        self._trending = {}     # limit -> (expires at, [(tag, score)])
+        self._pruned = None     # last bucket expired counters were pruned for
+        self.tagged = 0
+        self.trending_queries = 0
+        self.trending_hits = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['tags'] = self
+        self.app = app
+        with self._lock:
+            self._trending = {}
+        self._pruned = None
+        self.tagged = self.trending_queries = self.trending_hits = 0
+
+    def bucket(self, timestamp):
+        if timestamp.tzinfo is None:    # sqlite hands back naive UTC datetimes
+            timestamp = timestamp.replace(tzinfo=timezone.utc)
+        return int(timestamp.timestamp()) // self.app.config['TRENDING_BUCKET']
+
+    def add_post(self, post):
+        from app import db
+        from app.models import post_tag
+
+        tags = extract_tags(post.body)
+        if not tags:
+            return
+        db.session.execute(sa.insert(post_tag),
+                           [{'tag': tag, 'timestamp': post.timestamp, 'post_id': post.id} for tag in tags])
+        bucket = self.bucket(post.timestamp)
+        self.count(Counter((tag, bucket) for tag in tags))
+        self.tagged += 1
+        if bucket != self._pruned:
+            self._pruned = bucket
+            self.prune()
+
+    def count(self, counts):
+        """Add {(tag, bucket): n} to tag_count."""
+        from app import db
+        from app.models import tag_count
+
+        if not counts:
+            return
+        rows = [{'tag': tag, 'bucket': bucket, 'count': n} for (tag, bucket), n in counts.items()]
+        dialect = UPSERT_DIALECTS.get(db.engine.dialect.name)
+        if dialect is not None:
+            insert = dialect.insert(tag_count)
+            db.session.execute(
+                insert.on_conflict_do_update(index_elements=['tag', 'bucket'],
+                                             set_={'count': tag_count.c.count + insert.excluded.count}),
+                rows)
+            return
+        # any other backend: bump the counters that exist, insert the rest
+        for row in rows:
+            if self._bump(row):
+                continue
+            try:
+                with db.session.begin_nested():
+                    db.session.execute(sa.insert(tag_count), row)
+            except IntegrityError:  # another writer inserted it first
+                self._bump(row)
+
+    def _bump(self, row):
+        from app import db
+        from app.models import tag_count
+
+        return db.session.execute(
+            sa.update(tag_count)
+            .where(tag_count.c.tag == row['tag'], tag_count.c.bucket == row['bucket'])
+            .values(count=tag_count.c.count + row['count'])).rowcount
+
+    def prune(self):
+        """Drop counters for buckets that have left the window."""
+        from app import db
+        from app.models import tag_count
+
+        oldest = int(time.time()) // self.app.config['TRENDING_BUCKET'] - self.app.config['TRENDING_WINDOW']
+        db.session.execute(sa.delete(tag_count).where(tag_count.c.bucket < oldest))
+
+    def trending(self, limit=None):
+        """[(tag, score)] for the hottest tags, cached for TRENDING_CACHE_SECONDS."""
+        from app import db
+        from app.models import tag_count
+
+        limit = limit or self.app.config['TRENDING_LIMIT']
+        now = time.time()
+        with self._lock:
+            self.trending_queries += 1
+            cached = self._trending.get(limit)
+            if cached is not None and cached[0] > now:
+                self.trending_hits += 1
+                return cached[1]
+        size, window = self.app.config['TRENDING_BUCKET'], self.app.config['TRENDING_WINDOW']
+        current = int(now) // size
+        oldest = current - window
+        # fraction of the oldest bucket still inside a window of exactly `window` buckets
+        weight = 1 - (now % size) / size
+        score = sa.func.sum(sa.case((tag_count.c.bucket == oldest, tag_count.c.count * weight),
+                                    else_=tag_count.c.count))
+        rows = db.session.execute(
+            sa.select(tag_count.c.tag, score)
+            .where(tag_count.c.bucket >= oldest)
+            .group_by(tag_count.c.tag)
+            .order_by(score.desc(), tag_count.c.tag)
+            .limit(limit)).all()
+        result = [(tag, score) for tag, score in rows if score >= 1]
+        with self._lock:
+            self._trending[limit] = (now + self.app.config['TRENDING_CACHE_SECONDS'], result)
+        return result
+
+    def backfill(self, chunk_size=1000):
+        """Rebuild post_tag and tag_count from every post, `chunk_size` posts per transaction.
+
+        Yields the number of posts processed after each chunk.
+        """
+        from app import db
+        from app.models import Post, post_tag, tag_count
+
+        db.session.execute(sa.delete(post_tag))
+        db.session.execute(sa.delete(tag_count))
+        db.session.commit()
+        oldest = int(time.time()) // self.app.config['TRENDING_BUCKET'] - self.app.config['TRENDING_WINDOW']
+        last_id, done = 0, 0
+        while True:
+            rows = db.session.execute(
+                sa.select(Post.id, Post.body, Post.timestamp)
+                .where(Post.id > last_id).order_by(Post.id).limit(chunk_size)).all()
+            if not rows:
+                break
+            links, counts = [], Counter()
+            for id, body, timestamp in rows:
+                tags = extract_tags(body)
+                links.extend({'tag': tag, 'timestamp': timestamp, 'post_id': id} for tag in tags)
+                bucket = self.bucket(timestamp)
+                if tags and bucket >= oldest:
+                    counts.update((tag, bucket) for tag in tags)
+            if links:
+                db.session.execute(sa.insert(post_tag), links)
+            self.count(counts)
+            db.session.commit()
+            last_id = rows[-1].id
+            done += len(rows)
+            yield done
+        with self._lock:
+            self._trending = {}
+
+    def stats(self):
+        return {
+            'tagged_posts': self.tagged,
+            'trending_queries': self.trending_queries,
+            'trending_hits': self.trending_hits,
+        }
@@ -0,0 +1,167 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+import sqlalchemy as sa
+import sqlalchemy.orm as saorm
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+
+class MemoryBackend:
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()   # user id -> (expires at, payload)
+
+    def get(self, id):
+        with self._lock:
+            entry = self._entries.get(id)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self._entries[id]
+                return None
+            self._entries.move_to_end(id)
+            return entry[1]
+
+    def set(self, id, payload, ttl):
+        with self._lock:
+            self._entries[id] = (time.monotonic() + ttl, payload)
+            self._entries.move_to_end(id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, id):
+        with self._lock:
+            self._entries.pop(id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class RedisBackend:
+    def __init__(self, url, prefix='microblog:user:'):
+        if redis is None:
+            raise RuntimeError('USER_CACHE_REDIS_URL is set but the redis package is not installed')
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def get(self, id):
+        payload = self.client.get(f'{self.prefix}{id}')
+        return payload.decode('utf-8') if payload is not None else None
+
+    def set(self, id, payload, ttl):
+        self.client.set(f'{self.prefix}{id}', payload, ex=ttl)
+
+    def delete(self, id):
+        self.client.delete(f'{self.prefix}{id}')
+
+    def clear(self):
+        pass    # shared with other processes, entries run out on their TTL
+
+    def __len__(self):
+        return 0
+
+
+class UserCache:
+    """Short-TTL cache behind the Flask-Login user loader.
+
+    Holds the plain column values of logged in users for USER_CACHE_TTL
+    seconds, in process or in redis when USER_CACHE_REDIS_URL is set. A hit
+    is merged into the session with load=False, so it costs no query.
+    Counters and the password hash are not cached and load on first use.
+    An entry is dropped once a commit changes one of its columns, and on
+    logout.
+    """
+
+    COLUMNS = ('id', 'username', 'email', 'about_me', 'last_seen')
+    WATCHED = COLUMNS + ('password_hash',)
+
+    def __init__(self, app=None):
+        self.app = None
+        self.backend = None
+        self.ttl = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        from app.models import User
+
+        app.extensions['user_cache'] = self
+        self.app = app
+        self.ttl = app.config['USER_CACHE_TTL']
+        if app.config['USER_CACHE_REDIS_URL']:
+            self.backend = RedisBackend(app.config['USER_CACHE_REDIS_URL'])
+        else:
+            self.backend = MemoryBackend(app.config['USER_CACHE_MAX_ENTRIES'])
+        self.backend.clear()
+        self.hits = self.misses = self.invalidations = 0
+        if not sa.event.contains(User, 'after_update', self._user_updated):
+            sa.event.listen(User, 'after_update', self._user_updated)
+            sa.event.listen(saorm.Session, 'after_commit', self._after_commit)
+            sa.event.listen(saorm.Session, 'after_soft_rollback', self._after_rollback)
+
+    def get(self, id):
+        from app import db
+        from app.models import User
+
+        payload = self.backend.get(id) if self.ttl else None
+        if payload is None:
+            self.misses += 1
+            user = db.session.get(User, id)
+            if user is not None and self.ttl:
+                self.backend.set(id, self._dump(user), self.ttl)
+            return user
+        self.hits += 1
+        user = User(**self._load(payload))
+        saorm.make_transient_to_detached(user)
+        return db.session.merge(user, load=False)
+
+    def invalidate(self, id):
+        self.invalidations += 1
+        self.backend.delete(id)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self.backend),
+            'hits': self.hits,
+            'misses': self.misses,
+            'invalidations': self.invalidations,
+            'hit_ratio': self.hits / lookups if lookups else 0.0,
+        }
+
+    def _dump(self, user):
+        values = {name: getattr(user, name) for name in self.COLUMNS}
+        return json.dumps(values, default=lambda value: value.isoformat())
+
+    def _load(self, payload):
+        values = json.loads(payload)
+        if values['last_seen'] is not None:
+            values['last_seen'] = datetime.fromisoformat(values['last_seen'])
+        return values
+
+    def _user_updated(self, mapper, connection, user):
+        state = sa.inspect(user)
+        if any(state.attrs[name].history.has_changes() for name in self.WATCHED):
+            # dropped after commit, dropping now would let a request re-cache the old row
+            state.session.info.setdefault('user_cache_stale', set()).add(user.id)
+
+    def _after_commit(self, session):
+        for id in session.info.pop('user_cache_stale', ()):
+            self.invalidate(id)
+
+    def _after_rollback(self, session, previous_transaction):
+        session.info.pop('user_cache_stale', None)
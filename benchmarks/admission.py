@@ -0,0 +1,91 @@
+"""Concurrent load on the home feed, with and without admission control.
+
+Every thread is a logged-in client requesting /index back to back, pausing
+for --backoff seconds after a 503.
+
+    python -m benchmarks.admission --threads 32 --seconds 10 --limit 4
+"""
+import argparse
+import random
+import tempfile
+import threading
+import time
+from collections import Counter
+from app import create_app, db, admission
+from app.bench import seed_dataset, percentile
+from config import TestConfig
+
+
+def client_loop(app, user_id, deadline, backoff, results):
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['_user_id'] = str(user_id)
+        sess['_fresh'] = True
+    while time.monotonic() < deadline:
+        with app.app_context():
+            start = time.perf_counter()
+            response = client.get('/index')
+            results.append((response.status_code, (time.perf_counter() - start) * 1000))
+        if response.status_code == 503:
+            time.sleep(backoff)     # a well-behaved client backs off instead of retrying at once
+
+
+def run(app, threads, seconds, users, backoff):
+    results = []
+    deadline = time.monotonic() + seconds
+    rnd = random.Random(7)
+    workers = [threading.Thread(target=client_loop, args=(app, rnd.randint(1, users), deadline, backoff, results))
+               for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return results
+
+
+def report(name, results, seconds):
+    statuses = Counter(status for status, _ in results)
+    served = [ms for status, ms in results if status == 200]
+    shed = [ms for status, ms in results if status == 503]
+    line = f'{name:<10} {len(served) / seconds:7.1f} ok/s  {len(shed) / seconds:7.1f} shed/s'
+    if served:
+        line += f'  ok p50 {percentile(served, 50):7.1f} ms  p99 {percentile(served, 99):7.1f} ms'
+    if shed:
+        line += f'  shed p99 {percentile(shed, 99):6.1f} ms'
+    print(line)
+    unexpected = set(statuses) - {200, 503}
+    if unexpected:
+        print(f'           unexpected statuses: {sorted(unexpected)}')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--posts', type=int, default=10000)
+    parser.add_argument('--follows', type=int, default=20)
+    parser.add_argument('--threads', type=int, default=32)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--limit', type=int, default=4, help='concurrent feed requests when limited')
+    parser.add_argument('--queue', type=int, default=4)
+    parser.add_argument('--timeout', type=float, default=0.1)
+    parser.add_argument('--backoff', type=float, default=0.5, help='seconds a client waits after a 503')
+    args = parser.parse_args()
+
+    with tempfile.NamedTemporaryFile(suffix='.db') as f:
+        class BenchConfig(TestConfig):
+            SQLALCHEMY_DATABASE_URI = 'sqlite:///' + f.name
+            ADMISSION_QUEUE_SIZE = args.queue
+            ADMISSION_QUEUE_TIMEOUT = args.timeout
+
+        with create_app(BenchConfig).app_context():
+            db.create_all()
+            seed_dataset(args.users, args.posts, args.follows)
+        for name, limits in (('unlimited', {}), ('limited', {'feeds': args.limit})):
+            app = create_app(type('LoadConfig', (BenchConfig,), {'ADMISSION_LIMITS': limits}))
+            report(name, run(app, args.threads, args.seconds, args.users, args.backoff), args.seconds)
+            if limits:
+                print(f'           {admission.stats()["classes"]["feeds"]}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""Concurrent read throughput on SQLite: default settings vs. SQLITE_PRAGMAS.
+
+Reader threads page through explore while one writer keeps posting. With
+the default rollback journal every commit locks readers out; in WAL mode
+they keep reading the last committed snapshot.
+
+    python -m benchmarks.database --readers 8 --seconds 5
+"""
+import argparse
+import os
+import tempfile
+import threading
+import time
+import sqlalchemy as sa
+from app import create_app, db
+from app.bench import seed_dataset
+from app.models import Post
+from app.pagination import keyset_paginate
+from config import TestConfig
+
+
+def run(app, readers, seconds):
+    stop = threading.Event()
+    reads, writes, errors = [0] * readers, [0], [0]
+
+    def read(i):
+        while not stop.is_set():
+            with app.app_context():
+                try:
+                    keyset_paginate(sa.select(Post), 24)
+                    reads[i] += 1
+                except sa.exc.OperationalError:     # database is locked
+                    errors[0] += 1
+
+    def write():
+        while not stop.is_set():
+            with app.app_context():
+                try:
+                    db.session.execute(sa.insert(Post), [{'body': 'bench', 'user_id': 1}])
+                    db.session.commit()
+                    writes[0] += 1
+                except sa.exc.OperationalError:
+                    errors[0] += 1
+
+    threads = [threading.Thread(target=read, args=(i,)) for i in range(readers)]
+    threads.append(threading.Thread(target=write))
+    for t in threads:
+        t.start()
+    time.sleep(seconds)
+    stop.set()
+    for t in threads:
+        t.join()
+    return sum(reads) / seconds, writes[0] / seconds, errors[0]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--readers', type=int, default=8)
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--posts', type=int, default=20000)
+    args = parser.parse_args()
+
+    for label, pragmas in (('default', {}), ('tuned', TestConfig.SQLITE_PRAGMAS)):
+        path = tempfile.mkstemp(suffix='.db')[1]
+
+        class BenchConfig(TestConfig):
+            SQLALCHEMY_DATABASE_URI = 'sqlite:///' + path
+            SQLITE_PRAGMAS = pragmas
+            DATABASE_POOL_SIZE = args.readers + 1
+
+        app = create_app(BenchConfig)
+        with app.app_context():
+            db.create_all()
+            seed_dataset(1000, args.posts, 10)
+        reads, writes, errors = run(app, args.readers, args.seconds)
+        print(f'{label:<8} {reads:9.1f} reads/s {writes:8.1f} writes/s {errors:5d} lock errors')
+        with app.app_context():
+            db.engine.dispose()
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+"""Outgoing mail: inline sends vs. the pooled MailQueue.
+
+Uses the memory sink with a simulated per-message SMTP latency, so no mail
+server is needed.
+
+    python -m benchmarks.email --messages 200 --latency 0.02 --workers 4
+"""
+import argparse
+import time
+from unittest.mock import patch
+from flask_mail import Message
+from app import create_app, mail_queue
+from app.mailqueue import MemorySink
+from config import TestConfig
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=200)
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds per simulated SMTP send')
+    parser.add_argument('--workers', type=int, default=4)
+    args = parser.parse_args()
+
+    class BenchConfig(TestConfig):
+        MAIL_WORKERS = args.workers
+        MAIL_QUEUE_SIZE = args.messages
+
+    send = MemorySink.send
+    def slow_send(self, msg):
+        time.sleep(args.latency)
+        send(self, msg)
+
+    app = create_app(BenchConfig)
+    messages = [Message(f'message {i}', sender='bench@example.com', recipients=['to@example.com'],
+                        body='hello') for i in range(args.messages)]
+    with app.app_context(), patch.object(MemorySink, 'send', slow_send):
+        sink = MemorySink(app)
+        start = time.perf_counter()
+        for msg in messages:
+            sink.send(msg)
+        inline = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for msg in messages:
+            mail_queue.enqueue(msg)
+        enqueued = time.perf_counter() - start
+        mail_queue.join()
+        drained = time.perf_counter() - start
+        mail_queue.shutdown()
+
+    print(f'inline send:   {inline * 1000:8.1f} ms total, {inline / args.messages * 1000:6.2f} ms blocked per request')
+    print(f'queued send:   {enqueued * 1000:8.1f} ms total, {enqueued / args.messages * 1000:6.3f} ms blocked per request')
+    print(f'queue drained: {drained * 1000:8.1f} ms with {args.workers} workers, stats {mail_queue.stats()}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""Login throughput under concurrency: inline hashing vs. the process pool.
+
+Each run fires --logins POST /login requests from --threads client threads,
+while one more thread keeps fetching a cheap page to show how much hashing
+slows everything else down.
+
+    python -m benchmarks.login --threads 8 --logins 200 --workers 0 4
+"""
+import argparse
+import statistics
+import tempfile
+import threading
+import time
+import sqlalchemy as sa
+from app import create_app, db, hasher
+from app.bench import percentile
+from app.models import User
+from config import TestConfig
+
+
+def run(app, threads, logins, users):
+    done = threading.Event()
+    latencies, probes = [], []
+
+    def login(worker):
+        client = app.test_client()
+        for i in range(worker, logins, threads):
+            with client.session_transaction() as sess:
+                sess.clear()
+            start = time.perf_counter()
+            response = client.post('/login', data={'email': f'user{i % users}@example.com', 'password': 'bench'})
+            latencies.append((time.perf_counter() - start) * 1000)
+            assert response.status_code == 302, response.status_code
+
+    def probe():
+        client = app.test_client()
+        while not done.is_set():
+            start = time.perf_counter()
+            client.get('/reset_password_request')
+            probes.append((time.perf_counter() - start) * 1000)
+
+    workers = [threading.Thread(target=login, args=(i,)) for i in range(threads)]
+    prober = threading.Thread(target=probe)
+    prober.start()
+    start = time.perf_counter()
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    elapsed = time.perf_counter() - start
+    done.set()
+    prober.join()
+    return logins / elapsed, percentile(latencies, 95), statistics.median(probes)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--logins', type=int, default=200)
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--method', default='scrypt')
+    parser.add_argument('--workers', type=int, nargs='+', default=[0, 4], help='pool sizes to compare, 0 is inline')
+    args = parser.parse_args()
+
+    class BenchConfig(TestConfig):
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///' + tempfile.mkstemp(suffix='.db')[1]
+        PASSWORD_HASH_METHOD = args.method
+        PASSWORD_HASH_MAX_PENDING = args.threads
+
+    app = create_app(BenchConfig)
+    with app.app_context():
+        db.create_all()
+        password_hash = hasher.generate('bench')
+        db.session.execute(sa.insert(User), [
+            {'username': f'user{i}', 'email': f'user{i}@example.com', 'password_hash': password_hash}
+            for i in range(args.users)])
+        db.session.commit()
+
+    print(f'{args.logins} logins from {args.threads} threads, {args.method}')
+    for workers in args.workers:
+        app.config['PASSWORD_HASH_WORKERS'] = workers
+        hasher.shutdown()
+        if workers:     # start the pool outside the timed run
+            with app.app_context():
+                hasher.check(password_hash, 'bench')
+        throughput, p95, probe = run(app, args.threads, args.logins, args.users)
+        label = f'{workers} workers' if workers else 'inline'
+        print(f'{label:<10} {throughput:8.1f} logins/s  login p95 {p95:8.1f} ms  other requests p50 {probe:6.1f} ms')
+    hasher.shutdown()
+
+
+if __name__ == '__main__':
+    main()
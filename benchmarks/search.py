@@ -0,0 +1,78 @@
+"""Search query latency: inverted index vs. a LIKE '%term%' scan.
+
+Defaults to 1M posts in a temporary SQLite file, expect a few minutes of
+seeding. The memory backend needs several GB of RAM at that size.
+
+    python -m benchmarks.search --posts 1000000 --backend fts5
+"""
+import argparse
+import random
+import statistics
+import tempfile
+import time
+import sqlalchemy as sa
+from app import create_app, db, search
+from app.models import User, Post
+from app.search import FTS5Index, MemoryIndex
+from config import TestConfig
+
+QUERIES = ['flask', 'sqlite index', 'zebra', 'word42 word7', 'word999']
+
+
+def seed(posts, chunk_size=50000):
+    rnd = random.Random(42)
+    vocabulary = [f'word{i}' for i in range(1000)] + ['flask', 'sqlite', 'index', 'zebra']
+    weights = [1 / (rank + 1) for rank in range(len(vocabulary))]     # Zipf-like term frequencies
+    db.session.execute(sa.insert(User), [
+        {'id': i, 'username': f'user{i}', 'email': f'user{i}@example.com'} for i in range(1, 1001)])
+    for start in range(0, posts, chunk_size):
+        db.session.execute(sa.insert(Post), [
+            {'body': ' '.join(rnd.choices(vocabulary, weights, k=rnd.randint(3, 15))),
+             'user_id': rnd.randint(1, 1000)}
+            for _ in range(start, min(start + chunk_size, posts))])
+    db.session.commit()
+
+
+def timed(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--posts', type=int, default=1000000)
+    parser.add_argument('--backend', choices=['fts5', 'memory'], default='fts5')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.NamedTemporaryFile(suffix='.db') as f:
+        class BenchConfig(TestConfig):
+            SQLALCHEMY_DATABASE_URI = 'sqlite:///' + f.name
+
+        app = create_app(BenchConfig)
+        with app.app_context():
+            db.create_all()
+            start = time.perf_counter()
+            seed(args.posts)
+            print(f'seeded {args.posts} posts in {time.perf_counter() - start:.1f}s')
+
+            search.index = FTS5Index(db) if args.backend == 'fts5' else MemoryIndex(db)
+            start = time.perf_counter()
+            search.reindex(chunk_size=50000)
+            db.session.commit()
+            print(f'{args.backend} reindex in {time.perf_counter() - start:.1f}s')
+
+            print(f'{"query":<14} {"index p50":>12} {"LIKE p50":>12}')
+            for q in QUERIES:
+                indexed = timed(lambda: search.posts(q, 1, 24), args.repeat)
+                like = sa.select(Post.id).where(*[Post.body.like(f'%{term}%') for term in q.split()]).limit(24)
+                scanned = timed(lambda: db.session.execute(like).all(), args.repeat)
+                print(f'{q:<14} {indexed:9.2f} ms {scanned:9.2f} ms')
+
+
+if __name__ == '__main__':
+    main()
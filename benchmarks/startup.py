@@ -0,0 +1,82 @@
+"""Cold start: import, create_app() and the first rendered response.
+
+Every run is a fresh interpreter, timed without the template cache, with an
+empty cache directory and with one filled by `flask templates precompile`.
+
+    python -m benchmarks.startup --runs 10
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+CHILD = '''
+import json, sys, time
+start = time.perf_counter()
+from app import create_app, db
+from config import TestConfig
+imported = time.perf_counter()
+
+class StartupConfig(TestConfig):
+    SQLALCHEMY_DATABASE_URI = 'sqlite:///' + sys.argv[2]
+    TEMPLATE_CACHE_DIR = sys.argv[1] or None
+
+app = create_app(StartupConfig)
+created = time.perf_counter()
+with app.app_context():
+    db.create_all()
+    response = app.test_client().get('/login')
+    assert response.status_code == 200, response.status_code
+done = time.perf_counter()
+print(json.dumps({'import': imported - start, 'create_app': created - imported,
+                  'first_response': done - created, 'total': done - start,
+                  'migrate_loaded': 'flask_migrate' in sys.modules}))
+'''
+
+
+def run(cache_dir):
+    with tempfile.NamedTemporaryFile(suffix='.db') as f:
+        out = subprocess.run([sys.executable, '-c', CHILD, cache_dir or '', f.name],
+                             check=True, capture_output=True, text=True)
+    return json.loads(out.stdout.splitlines()[-1])
+
+
+def precompile(cache_dir):
+    from app import create_app
+    from config import TestConfig
+
+    class PrecompileConfig(TestConfig):
+        TEMPLATE_CACHE_DIR = cache_dir
+
+    result = create_app(PrecompileConfig).test_cli_runner().invoke(args=['templates', 'precompile'])
+    assert result.exit_code == 0, result.output
+
+
+def report(name, samples):
+    cells = '  '.join(f'{key} {statistics.median(s[key] for s in samples) * 1000:7.1f} ms'
+                      for key in ('import', 'create_app', 'first_response', 'total'))
+    print(f'{name:<12} {cells}')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=10)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root:
+        none = [run(None) for _ in range(args.runs)]
+        cold = [run(os.path.join(root, f'cold{i}')) for i in range(args.runs)]
+        warm_dir = os.path.join(root, 'warm')
+        precompile(warm_dir)
+        warm = [run(warm_dir) for _ in range(args.runs)]
+    report('no cache', none)
+    report('cold cache', cold)
+    report('precompiled', warm)
+    print(f'flask_migrate imported: {any(s["migrate_loaded"] for s in none + cold + warm)}')
+
+
+if __name__ == '__main__':
+    main()
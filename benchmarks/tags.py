@@ -0,0 +1,84 @@
+"""Tag feed: post_tag index vs. a LIKE scan of Post.body.
+
+Hashtags are appended to a fraction of the seeded posts, drawn from a
+power law so some tags are common and most are rare.
+
+    python -m benchmarks.tags --posts 100000 --tags 500
+"""
+import argparse
+import random
+import statistics
+import tempfile
+import time
+import sqlalchemy as sa
+from app import create_app, db, tags
+from app.bench import seed_dataset
+from app.models import Post, post_tag
+from config import TestConfig
+
+
+def tag_feed(name):
+    # the query behind /tag/<name>
+    return (sa.select(Post)
+            .join(post_tag, post_tag.c.post_id == Post.id)
+            .where(post_tag.c.tag == name)
+            .order_by(post_tag.c.timestamp.desc(), post_tag.c.post_id.desc()))
+
+
+def like_feed(name):
+    # also matches longer tags sharing the prefix, the index has no such problem
+    return sa.select(Post).where(Post.body.like(f'%#{name}%')).order_by(Post.timestamp.desc())
+
+
+def timed(query, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        db.session.scalars(query.limit(24)).all()
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--posts', type=int, default=100000)
+    parser.add_argument('--tags', type=int, default=500, help='distinct hashtags')
+    parser.add_argument('--tagged', type=float, default=0.3, help='fraction of posts with a hashtag')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.NamedTemporaryFile(suffix='.db') as f:
+        class BenchConfig(TestConfig):
+            SQLALCHEMY_DATABASE_URI = 'sqlite:///' + f.name
+
+        app = create_app(BenchConfig)
+        with app.app_context():
+            db.create_all()
+            seed_dataset(args.users, args.posts, 10)
+            rnd = random.Random(11)
+            updates = [{'id': id, 'body': f'{body} #tag{min(int(rnd.paretovariate(1.0)), args.tags)}'}
+                       for id, body in db.session.execute(sa.select(Post.id, Post.body))
+                       if rnd.random() < args.tagged]
+            db.session.execute(sa.update(Post), updates)
+            db.session.commit()
+            start = time.perf_counter()
+            for _ in tags.backfill(10000):
+                pass
+            print(f'backfill: {args.posts} posts in {time.perf_counter() - start:.1f}s')
+
+            counts = dict(db.session.execute(
+                sa.select(post_tag.c.tag, sa.func.count()).group_by(post_tag.c.tag)).all())
+            ranked = sorted(counts, key=counts.get, reverse=True)
+            for label, name in (('common', ranked[0]), ('median', ranked[len(ranked) // 2]), ('rare', ranked[-1])):
+                print(f'{label:<7} #{name:<8} {counts[name]:6} posts  '
+                      f'post_tag {timed(tag_feed(name), args.repeat):8.2f} ms  '
+                      f'LIKE {timed(like_feed(name), args.repeat):8.2f} ms')
+
+            start = time.perf_counter()
+            tags.trending()
+            print(f'trending: {(time.perf_counter() - start) * 1000:.2f} ms uncached')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""Home feed: old followers join vs. materialized timeline.
+
+    python -m benchmarks.timeline --users 500 --posts 10000 --follows 20
+"""
+import argparse
+import random
+import statistics
+import tempfile
+import time
+import sqlalchemy as sa
+import sqlalchemy.orm as saorm
+from app import create_app, db
+from app.bench import seed_dataset
+from app.models import User, Post
+from config import TestConfig
+
+
+def join_following_posts(user):
+    # the query following_posts() used before the timeline table existed
+    Author = saorm.aliased(User)
+    Follower = saorm.aliased(User)
+    return (
+        sa.select(Post)
+        .join(Post.author.of_type(Author))
+        .join(Author.followers.of_type(Follower), isouter=True)
+        .where(sa.or_(Follower.id == user.id, Author.id == user.id))
+        .group_by(Post)
+        .order_by(Post.timestamp.desc())
+    )
+
+
+def timed(query, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        db.session.scalars(query.limit(24)).all()
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--posts', type=int, default=10000)
+    parser.add_argument('--follows', type=int, default=20, help='mean follows per user')
+    parser.add_argument('--sample', type=int, default=20)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.NamedTemporaryFile(suffix='.db') as f:
+        class BenchConfig(TestConfig):
+            SQLALCHEMY_DATABASE_URI = 'sqlite:///' + f.name
+            TIMELINE_CELEBRITY_THRESHOLD = max(args.users // 10, 1)
+
+        app = create_app(BenchConfig)
+        with app.app_context():
+            db.create_all()
+            seed_dataset(args.users, args.posts, args.follows)
+
+            readers = random.Random(7).sample(range(1, args.users + 1), args.sample)
+            old, new = [], []
+            for user_id in readers:
+                user = db.session.get(User, user_id)
+                old.append(timed(join_following_posts(user), args.repeat))
+                new.append(timed(user.following_posts(limit=24), args.repeat))
+            print(f'join query:     median {statistics.median(old):8.2f} ms  max {max(old):8.2f} ms')
+            print(f'timeline query: median {statistics.median(new):8.2f} ms  max {max(new):8.2f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""Feed pages over a real socket: time to first byte and bytes on the wire.
+
+Every combination of buffered or streamed rendering and identity, gzip or
+(when installed) brotli encoding is timed against a local server.
+
+    python -m benchmarks.ttfb --posts-per-page 100 --repeat 20
+"""
+import argparse
+import http.client
+import statistics
+import tempfile
+import threading
+import time
+from werkzeug.serving import WSGIRequestHandler, make_server
+from app import create_app, db
+from app.bench import seed_dataset
+from app.compression import brotli
+from app.models import User
+from config import TestConfig
+
+
+def fetch(port, path, cookie, encoding):
+    conn = http.client.HTTPConnection('127.0.0.1', port)
+    start = time.perf_counter()
+    conn.request('GET', path, headers={'Cookie': cookie, 'Accept-Encoding': encoding})
+    response = conn.getresponse()
+    first = response.read(1)    # http.client has the headers before any of the body
+    ttfb = time.perf_counter() - start
+    body = first + response.read()
+    total = time.perf_counter() - start
+    conn.close()
+    assert response.status == 200, response.status
+    return ttfb * 1000, total * 1000, len(body)
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_request(self, *args):
+        pass
+
+
+def serve(app):
+    server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=QuietHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--posts', type=int, default=5000)
+    parser.add_argument('--posts-per-page', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+    encodings = ['identity', 'gzip'] + (['br'] if brotli is not None else [])
+
+    with tempfile.NamedTemporaryFile(suffix='.db') as f:
+        class BenchConfig(TestConfig):
+            SQLALCHEMY_DATABASE_URI = 'sqlite:///' + f.name
+            POSTS_PER_PAGE = args.posts_per_page
+            POST_CACHE_MAX_BYTES = 0    # render every row, as on a cold cache
+
+        with create_app(BenchConfig).app_context():
+            db.create_all()
+            seed_dataset(args.users, args.posts, 20)
+            username = db.session.get(User, 1).username
+
+        print(f'{"page":<10} {"mode":<9} {"encoding":<9} {"ttfb":>9} {"total":>9} {"bytes":>8}')
+        for streaming in (False, True):
+            app = create_app(type('ServeConfig', (BenchConfig,), {'TEMPLATE_STREAMING': streaming}))
+            client = app.test_client()
+            with client.session_transaction() as sess:
+                sess['_user_id'] = '1'
+                sess['_fresh'] = True
+            cookie = f'session={client.get_cookie("session").value}'
+            server = serve(app)
+            try:
+                for path in ('/explore', f'/user/{username}'):
+                    for encoding in encodings:
+                        samples = [fetch(server.port, path, cookie, encoding) for _ in range(args.repeat)]
+                        ttfb, total, size = (statistics.median(column) for column in zip(*samples))
+                        print(f'{path.split("/")[1]:<10} {"stream" if streaming else "buffered":<9} '
+                              f'{encoding:<9} {ttfb:7.2f}ms {total:7.2f}ms {size:8.0f}')
+            finally:
+                server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -7,6 +7,17 @@ class Config:
     SECRET_KEY = os.getenv('SECRET_KEY', 'default_fallback_key')
     SQLALCHEMY_DATABASE_URI = os.getenv('SQLALCHEMY_DATBASE_URI', 'sqlite:///app.db')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    DATABASE_REPLICA_URIS = [uri for uri in (os.environ.get('DATABASE_REPLICA_URIS') or '').split(',') if uri]
+    DATABASE_READ_YOUR_WRITES = 5   # seconds a client reads from the primary after writing
+    DATABASE_POOL_SIZE = int(os.environ.get('DATABASE_POOL_SIZE') or 5)
+    DATABASE_MAX_OVERFLOW = int(os.environ.get('DATABASE_MAX_OVERFLOW') or 10)
+    DATABASE_POOL_TIMEOUT = 30
+    SQLITE_PRAGMAS = {
+        'journal_mode': 'WAL',          # readers don't block the writer or each other
+        'synchronous': 'NORMAL',        # safe with WAL, fsyncs at checkpoints only
+        'mmap_size': 256 * 1024 * 1024,
+        'busy_timeout': 5000,           # ms to wait for a lock instead of failing at once
+    }
 
     MAIL_SERVER = os.environ.get('MAIL_SERVER')
     MAIL_PORT = int(os.environ.get('MAIL_PORT') or 25)
@@ -15,11 +26,102 @@ class Config:
     MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD')
     ADMINS = ['xiqor@list.ru']
 
+    MAIL_SINK = os.environ.get('MAIL_SINK') or 'smtp'     # smtp, memory or file
+    MAIL_SINK_DIR = os.environ.get('MAIL_SINK_DIR') or 'logs/mail'
+    MAIL_WORKERS = int(os.environ.get('MAIL_WORKERS') or 2)
+    MAIL_QUEUE_SIZE = int(os.environ.get('MAIL_QUEUE_SIZE') or 1000)
+    MAIL_ENQUEUE_TIMEOUT = 1
+    MAIL_IDLE_TIMEOUT = 5
+    MAIL_MAX_RETRIES = 3
+    MAIL_RETRY_BACKOFF = 1.0
+    MAIL_DEAD_LETTER_LOG = 'logs/mail_dead_letter.log'
+
+    # compiled Jinja bytecode, filled lazily or ahead of time by `flask templates precompile`
+    TEMPLATE_CACHE_DIR = os.environ.get('TEMPLATE_CACHE_DIR') or 'instance/jinja_cache'
+
+    LOG_FILE = 'logs/blogapp.log'
+    LOG_BUFFER_CAPACITY = 100       # records buffered before a file write, ERROR flushes at once
+    LOG_FLUSH_INTERVAL = 5
+    LOG_MAIL_INTERVAL = 300         # at most one error digest email per interval
+    LOG_MAIL_DELAY = 10             # how long a digest waits for the rest of a burst
+
     POSTS_PER_PAGE = 24
+    API_MAX_PER_PAGE = 100
+    API_MAX_BATCH = 100
+    POST_CACHE_MAX_BYTES = int(os.environ.get('POST_CACHE_MAX_BYTES') or 8 * 1024 * 1024)
+
+    TIMELINE_CELEBRITY_THRESHOLD = int(os.environ.get('TIMELINE_CELEBRITY_THRESHOLD') or 10000)
+    TIMELINE_BACKFILL = int(os.environ.get('TIMELINE_BACKFILL') or 200)
+    TIMELINE_MAX_ROWS = int(os.environ.get('TIMELINE_MAX_ROWS') or 1000)    # per reader, kept by `flask timeline trim`
+
+    GRAPH_MAX_AGE = int(os.environ.get('GRAPH_MAX_AGE') or 300)    # seconds before reloading follows from the database
+    GRAPH_COMPACT_THRESHOLD = 1000
+    SUGGESTIONS_LIMIT = 5
+    SUGGESTIONS_CACHE_SECONDS = 300     # per user, dropped early when they follow or unfollow
+    SUGGESTIONS_CACHE_ENTRIES = 10000
+
+    STREAM_REDIS_URL = os.environ.get('STREAM_REDIS_URL')    # share /stream events between processes
+    STREAM_QUEUE_SIZE = 32          # fragments buffered per connection before it is dropped
+    STREAM_HEARTBEAT = 15
+    STREAM_MAX_AGE = 300            # seconds before a connection is closed and the client reconnects
+    STREAM_MAX_CONNECTIONS = int(os.environ.get('STREAM_MAX_CONNECTIONS') or 256)  # per process
+    STREAM_MAX_PER_USER = 4         # open tabs per user, the rest get a 503
+
+    TRENDING_BUCKET = 3600          # seconds per tag counter bucket
+    TRENDING_WINDOW = 24            # buckets summed for trending topics
+    TRENDING_LIMIT = 10
+    TRENDING_CACHE_SECONDS = 60
+
+    AVATAR_PROVIDER = os.environ.get('AVATAR_PROVIDER') or 'local'     # local identicons or gravatar
+    AVATAR_CACHE_DIR = os.environ.get('AVATAR_CACHE_DIR') or 'instance/avatars'
+    AVATAR_CACHE_ENTRIES = 1024     # rendered PNGs also kept in memory
+    AVATAR_SIZES = (24, 70, 128)    # the sizes the app links to, any other is a 404
+    AVATAR_DISK_ENTRIES = int(os.environ.get('AVATAR_DISK_ENTRIES') or 100000)  # files, oldest removed first
+
+    TEMPLATE_STREAMING = os.environ.get('TEMPLATE_STREAMING') is not None   # stream feed pages as they render
+    TEMPLATE_STREAM_BUFFER = 4096   # characters per streamed write
+
+    COMPRESS_LEVEL = int(os.environ.get('COMPRESS_LEVEL') or 6)    # gzip level, 0 disables compression
+    COMPRESS_BROTLI_QUALITY = 5     # used when the brotli package is installed
+    COMPRESS_MIN_SIZE = 1024        # bytes, smaller bodies are sent as they are
+    COMPRESS_MIMETYPES = ['text/html', 'application/json']
 
     LANGUAGES = ['en', 'ru', 'es']
 
+    SEARCH_BACKEND = os.environ.get('SEARCH_BACKEND') or 'auto'    # auto, fts5 or memory
+    SEARCH_USERS_LIMIT = 5
+
+    LAST_SEEN_GRANULARITY = int(os.environ.get('LAST_SEEN_GRANULARITY') or 60)
+    LAST_SEEN_FLUSH_INTERVAL = int(os.environ.get('LAST_SEEN_FLUSH_INTERVAL') or 10)
+
+    USER_CACHE_TTL = int(os.environ.get('USER_CACHE_TTL') or 30)     # seconds, 0 disables the cache
+    USER_CACHE_MAX_ENTRIES = 10000
+    USER_CACHE_REDIS_URL = os.environ.get('USER_CACHE_REDIS_URL')    # share the cache between workers
+
+    PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD') or 'scrypt'   # werkzeug method, e.g. pbkdf2:sha256:600000
+    PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS') or 2)   # 0 hashes inline
+    PASSWORD_HASH_MAX_PENDING = int(os.environ.get('PASSWORD_HASH_MAX_PENDING') or 16)
+    PASSWORD_HASH_TIMEOUT = 10
+
+    # requests served at once per endpoint class and process, see app/admission.py; a missing class is unlimited
+    ADMISSION_LIMITS = {'feeds': 16, 'auth': 4, 'writes': 8, 'avatars': 8}
+    ADMISSION_QUEUE_SIZE = 8        # requests waiting per class, the rest get a 503 at once
+    ADMISSION_QUEUE_TIMEOUT = 0.5   # seconds a queued request waits for a slot
+    ADMISSION_RETRY_AFTER = 1
+    RATE_LIMITS = {'follow': (0.5, 20), 'post': (0.1, 10)}    # per user: tokens per second, burst
+    RATE_LIMIT_MAX_USERS = 100000
+
+    PERF_ENABLED = os.environ.get('PERF_ENABLED') is not None
+    PERF_LOG_SAMPLE_RATE = float(os.environ.get('PERF_LOG_SAMPLE_RATE') or 0.01)
+    PERF_STATS_TOKEN = os.environ.get('PERF_STATS_TOKEN')     # bearer token for /_stats, admins always allowed
+
 class TestConfig(Config):
     TESTING = True
     SQLALCHEMY_DATABASE_URI = os.getenv('SQLALCHEMY_DATBASE_URI', 'sqlite:///:memory:')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    WTF_CSRF_ENABLED = False
+    LAST_SEEN_FLUSH_INTERVAL = 0    # no background flusher, tests flush explicitly
+    MAIL_SINK = 'memory'
+    PASSWORD_HASH_WORKERS = 0
+    TEMPLATE_CACHE_DIR = None
+    AVATAR_CACHE_DIR = None
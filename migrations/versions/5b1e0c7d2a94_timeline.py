@@ -0,0 +1,32 @@
+"""timeline
+
+Revision ID: 5b1e0c7d2a94
+Revises: 31fc65e2b360
+Create Date: 2026-10-18 10:12:41.503217
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5b1e0c7d2a94'
+down_revision = '31fc65e2b360'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('timeline',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('timestamp', sa.DateTime(), nullable=False),
+    sa.Column('post_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['post_id'], ['post.id'], ),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('user_id', 'timestamp', 'post_id')
+    )
+    # run `flask timeline rebuild` afterwards to fill it for existing users
+
+
+def downgrade():
+    op.drop_table('timeline')
@@ -0,0 +1,40 @@
+"""user counters
+
+Revision ID: a83f4d61c2e7
+Revises: 5b1e0c7d2a94
+Create Date: 2026-10-18 11:02:17.880412
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a83f4d61c2e7'
+down_revision = '5b1e0c7d2a94'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('num_followers', sa.Integer(), server_default='0', nullable=False))
+        batch_op.add_column(sa.Column('num_following', sa.Integer(), server_default='0', nullable=False))
+        batch_op.add_column(sa.Column('num_posts', sa.Integer(), server_default='0', nullable=False))
+
+    user = sa.table('user', sa.column('id'), sa.column('num_followers'),
+                    sa.column('num_following'), sa.column('num_posts'))
+    followers = sa.table('followers', sa.column('follower_id'), sa.column('followed_id'))
+    post = sa.table('post', sa.column('user_id'))
+    op.execute(user.update().values(
+        num_followers=sa.select(sa.func.count()).where(followers.c.followed_id == user.c.id).scalar_subquery(),
+        num_following=sa.select(sa.func.count()).where(followers.c.follower_id == user.c.id).scalar_subquery(),
+        num_posts=sa.select(sa.func.count()).where(post.c.user_id == user.c.id).scalar_subquery(),
+    ))
+
+
+def downgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.drop_column('num_posts')
+        batch_op.drop_column('num_following')
+        batch_op.drop_column('num_followers')
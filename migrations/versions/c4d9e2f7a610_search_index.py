@@ -0,0 +1,33 @@
+"""search index
+
+Revision ID: c4d9e2f7a610
+Revises: a83f4d61c2e7
+Create Date: 2026-10-18 13:40:05.114923
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c4d9e2f7a610'
+down_revision = 'a83f4d61c2e7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # FTS5 tables only exist on SQLite, other databases use the in-process index
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    op.execute('CREATE VIRTUAL TABLE IF NOT EXISTS post_fts USING fts5(body)')
+    op.execute('CREATE VIRTUAL TABLE IF NOT EXISTS user_fts USING fts5(username)')
+    op.execute('INSERT INTO post_fts(rowid, body) SELECT id, body FROM post')
+    op.execute('INSERT INTO user_fts(rowid, username) SELECT id, username FROM user')
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    op.execute('DROP TABLE IF EXISTS user_fts')
+    op.execute('DROP TABLE IF EXISTS post_fts')
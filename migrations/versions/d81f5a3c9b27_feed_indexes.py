@@ -0,0 +1,35 @@
+"""feed indexes
+
+Revision ID: d81f5a3c9b27
+Revises: c4d9e2f7a610
+Create Date: 2026-10-18 20:05:41.302118
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd81f5a3c9b27'
+down_revision = 'c4d9e2f7a610'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('post', schema=None) as batch_op:
+        batch_op.create_index('ix_post_user_id_timestamp', ['user_id', 'timestamp', 'id'], unique=False)
+        # a prefix of the new index
+        batch_op.drop_index('ix_post_user_id')
+
+    with op.batch_alter_table('followers', schema=None) as batch_op:
+        batch_op.create_index('ix_followers_followed_id_follower_id', ['followed_id', 'follower_id'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('followers', schema=None) as batch_op:
+        batch_op.drop_index('ix_followers_followed_id_follower_id')
+
+    with op.batch_alter_table('post', schema=None) as batch_op:
+        batch_op.create_index('ix_post_user_id', ['user_id'], unique=False)
+        batch_op.drop_index('ix_post_user_id_timestamp')
@@ -0,0 +1,43 @@
+"""hashtags
+
+Revision ID: e3a7c91b5f40
+Revises: d81f5a3c9b27
+Create Date: 2026-10-18 21:14:08.771902
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e3a7c91b5f40'
+down_revision = 'd81f5a3c9b27'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('post_tag',
+    sa.Column('tag', sa.String(length=64), nullable=False),
+    sa.Column('timestamp', sa.DateTime(), nullable=False),
+    sa.Column('post_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['post_id'], ['post.id'], ),
+    sa.PrimaryKeyConstraint('tag', 'timestamp', 'post_id')
+    )
+    op.create_table('tag_count',
+    sa.Column('tag', sa.String(length=64), nullable=False),
+    sa.Column('bucket', sa.Integer(), nullable=False),
+    sa.Column('count', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('tag', 'bucket')
+    )
+    with op.batch_alter_table('tag_count', schema=None) as batch_op:
+        batch_op.create_index('ix_tag_count_bucket', ['bucket'], unique=False)
+    # run `flask tags backfill` afterwards to index existing posts
+
+
+def downgrade():
+    with op.batch_alter_table('tag_count', schema=None) as batch_op:
+        batch_op.drop_index('ix_tag_count_bucket')
+
+    op.drop_table('tag_count')
+    op.drop_table('post_tag')